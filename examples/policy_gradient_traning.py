@@ -61,6 +61,9 @@ parser.add_argument('--bin-type', dest='BIN_TYPE', default="Simple", type=str,
                     help='options: Simple, Reductive, Timeline, OrderedTimeline')
 parser.add_argument('--bin-limit', dest='BIN_TASK_LIMIT', default=-1, type=int,
                     help='max number of tasks per bin. -1 means no limit')
+parser.add_argument('--order-nodes', dest='ORDER_NODES', default=-1, type=int,
+                    help='max insertions tried when ordering tasks of closed'
+                         ' OrderedTimeline bin. -1 means no limit')
 parser.add_argument('--len-tol', dest='LEN_TOL', default=-1, type=float,
                     help='tolerance of different lengths of tasks in bin. -1 means no limit')
 parser.add_argument('--pr-param', dest='PP', default=1, type=float)
@@ -73,6 +76,15 @@ parser.add_argument('--lr', dest='LR', default=0.005, type=float)
 parser.add_argument('--save-vars', dest='VARFILE', default=None, type=str,
                     help='path to create files to save model weights')
 parser.add_argument('--epochs', dest='N_EPOCHS', default=100, type=int)
+parser.add_argument('--workers', dest='N_WORKERS', default=1, type=int,
+                    help='number of processes running episodes.'
+                         ' More than 1 trains on their summed gradients')
+parser.add_argument('--episodes', dest='N_EPISODES', default=-1, type=int,
+                    help='episodes per learning step with --workers.'
+                         ' -1 means one per worker')
+parser.add_argument('--light-history', dest='LIGHT_HISTORY', action="store_true",
+                    help='keep model inputs instead of autograd graphs'
+                         ' of decisions during epoch')
 args = parser.parse_args()
 
 
@@ -84,14 +96,19 @@ if args.MAX_THREADS < 0:
     args.MAX_THREADS = 8
 if args.BIN_TASK_LIMIT < 0:
     args.BIN_TASK_LIMIT = None
+if args.ORDER_NODES < 0:
+    args.ORDER_NODES = None
 if args.LEN_TOL < 0:
     args.LEN_TOL = None
+if args.N_EPISODES < 0:
+    args.N_EPISODES = args.N_WORKERS
 
 
 OrderedTimelineBinLF = OrderedTimelineBinClass(
     orderAdd    = orderLongestFirst,
     orderRemove = orderLongestFirst,
-    orderClose  = orderExhausive,
+    orderClose  = lambda timeline, maxDims: \
+        orderExhausive(timeline, maxDims, nodeLimit=args.ORDER_NODES),
 )
 BINS = {
     'Simple': SimpleBin,
@@ -115,7 +132,8 @@ Model = lambda *largs, **kwargs: Model_v0_torch(*largs, **kwargs)
 
 VMPlacementPolicy = lambda *largs, **kwargs: \
     PolicyGradient(*largs, **kwargs,
-                   ModelClass=Model, lr=args.LR, gamma=args.GAMMA)
+                   ModelClass=Model, lr=args.LR, gamma=args.GAMMA,
+                   light_history=args.LIGHT_HISTORY)
 
 
 
@@ -174,7 +192,7 @@ def priorities(s):
     ''' return list of `s` random functions `int -> int` '''
     a_s = np.abs(np.random.normal(1, 0.3*args.PP, s))/100
     b_s = np.abs(np.random.normal(1, 1.0*args.PP, s))
-    return [(lambda t, a=a, b=b: a*t + b) for a, b in zip(a_s, b_s)]
+    return [LinearPriority(a, b) for a, b in zip(a_s, b_s)]
 
 gen = RandomJobGenerator(
     noCores=lambda s: 1 + np.random.binomial(
@@ -189,6 +207,49 @@ gen = RandomJobGenerator(
 
 
 
+'''
+Section 4a: PARALLEL TRAINING:
+    each episode is run by worker process in its own simulator,
+    on its own copy of infrastructure and model
+'''
+
+def makeEpisode():
+    ''' set up infrastructure and jobs of one episode '''
+    Global.load(args.INF)
+    machines = [getMachine(MACHINE.RAM, MACHINE.CPU_CORES,
+                           MACHINE.GPUS, VMScheduler)
+                for MACHINE in Global.MACHINES]
+    infrastructure = Infrastructure(machines, VMPlacementPolicy)
+    vms = []
+    for job in gen.getJobs(args.NO_JOBS):
+        vm = CreateVM.minimal([job], ownCores=True)
+        vm.scheduleJob(job)
+        vms += [vm]
+    delayScheduler = VMDelayScheduler(infrastructure,
+            lambda n: np.random.uniform(0, args.SPAN, n))
+    delayScheduler.scheduleVM(vms)
+    return infrastructure
+
+if args.N_WORKERS > 1:
+    model = infrastructure._vmPlacementPolicy._model
+    trainer = ParallelPolicyGradient(makeEpisode, model, lr=args.LR,
+                                     n_episodes=args.N_EPISODES,
+                                     n_workers=args.N_WORKERS,
+                                     seed=max(args.SEED, 0))
+    for i in range(args.N_EPOCHS):
+        if args.VARFILE:
+            model.saveVars(f"{args.VARFILE}_{i}")
+        loss = trainer.step()
+        print(i)
+        print("loss:                          ", loss)
+        sys.stdout.flush()
+    if args.VARFILE:
+        model.saveVars(f"{args.VARFILE}_{args.N_EPOCHS}")
+    sys.exit()
+
+
+
+
 '''
 Section 4: TRAINING:
     Create JobGenerator instance
@@ -200,7 +261,7 @@ for i in range(args.N_EPOCHS):
     sim = Simulator.getInstance()
     sim = Simulator.getInstance()
     sim._eventQueue._currentTime = 0
-    sim._eventQueue._done = []
+    sim.history.clear()
 
     # save model parameters
     if args.VARFILE:
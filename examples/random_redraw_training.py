@@ -44,7 +44,7 @@ def run_simulation(generator, infrastructure, model, n_repeats=5):
     for _ in range(n_repeats):
         sim = Simulator.getInstance()
         sim._eventQueue._currentTime = 0
-        sim._eventQueue._done = []
+        sim.history.clear()
 
         jobs = generator.getJobs(args.NO_JOBS)
         #  totalOps = {}
@@ -90,6 +90,9 @@ parser.add_argument('--bin-type', dest='BIN_TYPE', default="Simple", type=str,
                     help='options: Simple, Reductive, Timeline, OrderedTimeline')
 parser.add_argument('--bin-limit', dest='BIN_TASK_LIMIT', default=-1, type=int,
                     help='max number of tasks per bin. -1 means no limit')
+parser.add_argument('--order-nodes', dest='ORDER_NODES', default=-1, type=int,
+                    help='max insertions tried when ordering tasks of closed'
+                         ' OrderedTimeline bin. -1 means no limit')
 parser.add_argument('--len-tol', dest='LEN_TOL', default=-1, type=float,
                     help='tolerance of different lengths of tasks in bin. -1 means no limit')
 parser.add_argument('--pr-param', dest='PP', default=1, type=float)
@@ -106,6 +109,8 @@ if args.MAX_THREADS < 0:
     args.MAX_THREADS = 8
 if args.BIN_TASK_LIMIT < 0:
     args.BIN_TASK_LIMIT = None
+if args.ORDER_NODES < 0:
+    args.ORDER_NODES = None
 if args.LEN_TOL < 0:
     args.LEN_TOL = None
 
@@ -113,7 +118,8 @@ if args.LEN_TOL < 0:
 OrderedTimelineBinLF = OrderedTimelineBinClass(
     orderAdd    = orderLongestFirst,
     orderRemove = orderLongestFirst,
-    orderClose  = orderExhausive,
+    orderClose  = lambda timeline, maxDims: \
+        orderExhausive(timeline, maxDims, nodeLimit=args.ORDER_NODES),
 )
 BINS = {
     'Simple': SimpleBin,
@@ -182,7 +188,7 @@ def priorities(s):
     ''' return list of `s` random functions `int -> int` '''
     a_s = np.abs(np.random.normal(1, 0.3*args.PP, s))/100
     b_s = np.abs(np.random.normal(1, 1.0*args.PP, s))
-    return [(lambda t, a=a, b=b: a*t + b) for a, b in zip(a_s, b_s)]
+    return [LinearPriority(a, b) for a, b in zip(a_s, b_s)]
 
 gen = RandomJobGenerator(
     noCores=lambda s: 1 + np.random.binomial(
@@ -45,6 +45,9 @@ parser.add_argument('--bin-type', dest='BIN_TYPE', default="Simple", type=str,
                     help='options: Simple, Reductive, Timeline, OrderedTimeline')
 parser.add_argument('--bin-limit', dest='BIN_TASK_LIMIT', default=-1, type=int,
                     help='max number of tasks per bin. -1 means no limit')
+parser.add_argument('--order-nodes', dest='ORDER_NODES', default=-1, type=int,
+                    help='max insertions tried when ordering tasks of closed'
+                         ' OrderedTimeline bin. -1 means no limit')
 parser.add_argument('--len-tol', dest='LEN_TOL', default=-1, type=float,
                     help='tolerance of different lengths of tasks in bin. -1 means no limit')
 parser.add_argument('--pr-param', dest='PP', default=1, type=float)
@@ -52,6 +55,10 @@ parser.add_argument('--placement-policy', dest='PLACEMENT_POLICY', default="Simp
                     help='options: Simple, Random, AI')
 parser.add_argument('--model', dest='MODEL', default="Random", type=str,
                     help='options: Random, v0_np, v0_torch')
+parser.add_argument('--batch-placement', dest='BATCH', default=None, type=str,
+                    help='options: exact, approximate. AI placements requested'
+                         ' at the same time are deferred to the end of it,'
+                         ' approximate scores them together')
 parser.add_argument('--inf', dest='INF', default="./infrastructure2.json", type=str,
                     help='path to file with infrastructure decription')
 parser.add_argument('--load-vars', dest='VARFILE', default=None, type=str,
@@ -65,6 +72,8 @@ if args.MAX_THREADS < 0:
     args.MAX_THREADS = 8
 if args.BIN_TASK_LIMIT < 0:
     args.BIN_TASK_LIMIT = None
+if args.ORDER_NODES < 0:
+    args.ORDER_NODES = None
 if args.LEN_TOL < 0:
     args.LEN_TOL = None
 
@@ -72,7 +81,8 @@ if args.LEN_TOL < 0:
 OrderedTimelineBinLF = OrderedTimelineBinClass(
     orderAdd    = orderLongestFirst,
     orderRemove = orderLongestFirst,
-    orderClose  = orderExhausive,
+    orderClose  = lambda timeline, maxDims: \
+        orderExhausive(timeline, maxDims, nodeLimit=args.ORDER_NODES),
 )
 BINS = {
     'Simple': SimpleBin,
@@ -107,7 +117,8 @@ PLACEMENT_POLICIES = {
     'Simple': VMPlacementPolicySimple,
     'Random': VMPlacementPolicyRandom,
     'AI': lambda *largs, **kwargs: \
-        VMPlacementPolicyAI(*largs, **kwargs, ModelClass=Model),
+        VMPlacementPolicyAI(*largs, **kwargs, ModelClass=Model,
+                            batch=args.BATCH),
 }
 VMPlacementPolicy = PLACEMENT_POLICIES[args.PLACEMENT_POLICY]
 
@@ -157,7 +168,7 @@ def priorities(s):
     ''' return list of `s` random functions `int -> int` '''
     a_s = np.abs(np.random.normal(1, 0.3*args.PP, s))/100
     b_s = np.abs(np.random.normal(1, 1.0*args.PP, s))
-    return [(lambda t, a=a, b=b: a*t + b) for a, b in zip(a_s, b_s)]
+    return [LinearPriority(a, b) for a, b in zip(a_s, b_s)]
 
 if args.JOBS_FILE is not None:
     gen = FromFileJobGenerator(args.JOBS_FILE, priorities)
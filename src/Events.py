@@ -102,6 +102,34 @@ class JobRecalculate(Event):
 
 
 
+class JobsRecalculate(Event):
+    """
+    Recalculation of all jobs, which resources changed in current
+    time instant. Has the lowest priority, so it is proceeded after
+    all other events of the instant and recalculates each job once.
+    """
+    # below every other event (batched vm placements have -50), so
+    # that changes made by all of them at the instant are included
+    def __init__(self, priority=-100):
+        super().__init__(lambda: None, "JobsRecalculate", priority)
+        self.jobs = {} # {job: None}, ordered by last change
+
+    @staticmethod
+    def markDirty(job):
+        sim = Simulator.getInstance()
+        jobs = sim.pendingRecalculation(JobsRecalculate).jobs
+        jobs.pop(job, None)
+        jobs[job] = None
+
+    def proceed(self):
+        Simulator.getInstance().recalculationStarted()
+        for job in self.jobs:
+            if job.host is None:
+                continue
+            JobRecalculate(job, job.host).proceed()
+
+
+
 class VMStart(Event):
     def __init__(self, host, vm, priority=10):
         super().__init__(lambda: None, f"VMStart_{vm.name}", priority)
@@ -179,7 +179,7 @@ class VMDelayScheduler:
             # make priorities 'start' at `time` instead of in 0
             for job in vm._jobScheduler._jobQueue:
                 job._old_pr = job._priority
-                job._priority = lambda t, f=job._old_pr, time=time: f(t - time)
+                job._priority = Priority.shift(job._priority, time)
             event = VMShedule(target, vm)
             sim.addEvent(time, event)
 
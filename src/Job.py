@@ -1,7 +1,9 @@
+import itertools
 from numbers import Number
 from sortedcontainers import SortedDict
 from Simulator import *
 from Resource import *
+from Priority import *
 
 
 class Job(ResourcesHolder):
@@ -9,12 +11,13 @@ class Job(ResourcesHolder):
     Job structure. Contains all information about job
     and provides mothods of it's procedure and maintenance.
     """
-    _noCreated = 0
+    _indices = itertools.count()
+    _userKind = 'job'
 
     def __init__(self, operations, resourceRequest,
                  name=None, priority=1):
         super().__init__(resourceRequest)
-        self._index = Job._noCreated
+        self._index = next(Job._indices)
         if (name is None):
             name = f"Job_{self._index}"
         assert type(name) is str
@@ -25,9 +28,8 @@ class Job(ResourcesHolder):
         self.operationsLeft = operations.copy()
         self.predictedFinish = None
         self._updates = [] # [(time, speed)]
-        Job._noCreated += 1
         if isinstance(priority, Number):
-            self._priority = lambda _: priority
+            self._priority = ConstantPriority(priority)
         else:
             self._priority = priority
 
@@ -35,6 +37,14 @@ class Job(ResourcesHolder):
     def priority(self):
         return self._priority(NOW())
 
+    @property
+    def linearPriority(self):
+        """
+        Returns (slope, intercept) of job's priority,
+        or None if priority is not linear.
+        """
+        return getattr(self._priority, 'coefficients', None)
+
     def getCurrentSpeeds(self):
         totalFrequency = dict.fromkeys(self.operationsLeft.keys(), 0)
         for resource in self.obtainedRes:
@@ -1,5 +1,7 @@
+import numpy as np
 from toolkit import INF
 from Simulator import *
+from Priority import *
 
 
 
@@ -35,6 +37,8 @@ class EventInspector(NotificationListener):
 class JobDelayMetric(NotificationListener):
     def __init__(self):
         self._jobs = {}
+        self.subscribe(NType.Other, message="VMSchedule")
+        self.subscribe(NType.JobStart)
 
     def _add(self, job, time, i):
         if job not in self._jobs:
@@ -53,15 +57,24 @@ class JobDelayMetric(NotificationListener):
     def _calculateCost(sched, start, f):
         raise NotImplementedError()
 
+    @classmethod
+    def _calculateCosts(cls, scheds, starts, fs):
+        """
+        Returns np.array of costs of many jobs at once.
+        """
+        return np.array([cls._calculateCost(sched, start, f)
+                         for sched, start, f in zip(scheds, starts, fs)])
+
     def cost(self, acceptZeroSchedule=True):
-        cost = 0
-        for job, (sched, start, f) in self._jobs.items():
-            assert start is not None
-            assert acceptZeroSchedule or sched > 0
-            assert start >= sched
-            assert f(sched) > 0
-            cost += self._calculateCost(sched, start, f)
-        return cost / len(self._jobs)
+        scheds, starts, fs = zip(*self._jobs.values())
+        assert None not in starts
+        scheds = np.array(scheds, dtype=float)
+        starts = np.array(starts, dtype=float)
+        assert acceptZeroSchedule or np.all(scheds > 0)
+        assert np.all(starts >= scheds)
+        assert np.all(Priority.evaluate(fs, scheds) > 0)
+        costs = self._calculateCosts(scheds, starts, fs)
+        return sum(costs.tolist()) / len(self._jobs)
 
 
 class PriorityIncreaseMetric(JobDelayMetric):
@@ -70,26 +83,39 @@ class PriorityIncreaseMetric(JobDelayMetric):
     def _calculateCost(sched, start, f):
         return f(start) - f(sched)
 
+    @classmethod
+    def _calculateCosts(cls, scheds, starts, fs):
+        return Priority.evaluate(fs, starts) - Priority.evaluate(fs, scheds)
+
 
 class AUPMetric(JobDelayMetric):
     """
-    Area Under Priority over time of waiting
-    assuming linear increase
+    Area Under Priority over time of waiting,
+    exact for priority objects, assuming linear
+    increase for other callables
     """
 
     @staticmethod
     def _calculateCost(sched, start, f):
+        if isinstance(f, Priority):
+            return f.integral(sched, start)
         t = start - sched
         p0 = f(sched)
         p1 = f(start)
         return t*(p1 + p0)/2
 
+    @classmethod
+    def _calculateCosts(cls, scheds, starts, fs):
+        return Priority.integrate(fs, scheds, starts)
+
 
 
 class EfficiencyCalculator(NotificationListener):
     def __init__(self):
         self._machines = {}
         self._running = {}
+        self.subscribe(NType.JobStart)
+        self.subscribe(NType.JobFinish)
 
     def _add(self, machine, resources):
         if machine not in self._machines:
@@ -109,7 +135,7 @@ class EfficiencyCalculator(NotificationListener):
         duration = NOW() - startTime
         for req in job.resourceRequest:
             if req.rtype not in resources:
-                assert req.value is not INF
+                assert req.value != INF
                 resources[req.rtype] = req.value * duration
         del self._running[job]
         return resources
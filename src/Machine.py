@@ -1,4 +1,7 @@
+import itertools
+import numpy as np
 from multiset import Multiset
+from sortedcontainers import SortedKeyList
 from Resource import *
 from toolkit import *
 
@@ -11,8 +14,18 @@ class Infrastructure:
     def __init__(self, machines, getVMPlacementPolicy):
         self.machines = set(machines)
         self._knownVMs = set()
+        self.capacityClasses = CapacityClass.group(self.machines)
+        # shared with placement policy, see `CapacityMatrix.shared`
+        self.capacities = CapacityMatrix(sorted(self.machines), track=True)
         self._vmPlacementPolicy = getVMPlacementPolicy(self.machines)
 
+    def feasibleMask(self, vm, free=False):
+        """
+        Returns boolean np.array over `self.capacities.machines`
+        (see `CapacityMatrix.feasibleMask`).
+        """
+        return self.capacities.feasibleMask(vm, free)
+
     def scheduleVM(self, vm):
         return self._vmPlacementPolicy.placeVM(vm)
 
@@ -23,47 +36,320 @@ class Infrastructure:
 
 
 
-class Machine:
+class CapacityClass:
+    """
+    Machines with identical maximal resources.
+    Fitting of resources holder is checked once per class
+    and shape of holder's resource request.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.machines = []
+        self._fittable = {} # {request shape: bool}
+
+    @staticmethod
+    def group(machines):
+        classes = {}
+        for machine in sorted(machines):
+            key = tuple(sorted(machine.maxResources))
+            if key not in classes:
+                classes[key] = CapacityClass(key)
+            classes[key].machines += [machine]
+            machine._capacityClass = classes[key]
+        return list(classes.values())
+
+    @staticmethod
+    def requestShape(resHolder):
+        return tuple((req.rtype, req.value, req.shared)
+                     for req in resHolder.resourceRequest)
+
+    def isFittable(self, resHolder):
+        shape = self.requestShape(resHolder)
+        if shape not in self._fittable:
+            machine = self.machines[0]
+            self._fittable[shape] = machine._checkFittable(resHolder)
+        return self._fittable[shape]
+
+
+
+class CapacityMatrix:
+    """
+    Dense matrices of machines' maximal and currently free resources
+    for vectorized feasibility checks. Columns are number of cores,
+    largest core, RAM, number of GPUs and largest GPU.
+    With `track`, machines mark their rows of free amounts outdated
+    on every allocation and freeing, rows are recomputed when read.
+    """
+    NoColumns = 5
+
+    def __init__(self, machines, track=False):
+        self.machines = list(machines)
+        self._rows = {m: i for i, m in enumerate(self.machines)}
+        self.capacities = np.array(
+                [self.summary(m.maxResources) for m in self.machines],
+                dtype=float).reshape(-1, self.NoColumns)
+        self._free = np.array(
+                [self._freeSummary(m) for m in self.machines],
+                dtype=float).reshape(-1, self.NoColumns)
+        self._outdated = set()
+        # machines of one capacity class share the exact fit check
+        classes = {}
+        for machine in self.machines:
+            key = machine._capacityClass or machine
+            classes.setdefault(key, len(classes))
+        self._representatives = list(classes.keys())
+        self._classOf = np.array([classes[m._capacityClass or m]
+                                  for m in self.machines], dtype=int)
+        if track:
+            for machine in self.machines:
+                machine._capacityMatrix = self
+
+    @classmethod
+    def shared(cls, machines):
+        """
+        Returns tracked matrix of exactly `machines` (e.g. one of their
+        infrastructure), or new untracked one if there is none.
+        """
+        machines = list(machines)
+        matrix = machines[0]._capacityMatrix if len(machines) > 0 else None
+        if matrix is not None and len(matrix.machines) == len(machines) \
+                and all(m._capacityMatrix is matrix for m in machines):
+            return matrix
+        return cls(machines)
+
+    @property
+    def free(self):
+        for machine in self._outdated:
+            self._free[self._rows[machine]] = self._freeSummary(machine)
+        self._outdated.clear()
+        return self._free
+
+    @staticmethod
+    def summary(amounts):
+        """
+        Returns row of matrix for given (rtype, value) pairs.
+        """
+        cores, ram, gpus = [], 0, []
+        for rtype, value in amounts:
+            if rtype == RType.CPU_core:
+                cores += [value]
+            elif rtype == RType.RAM:
+                ram += value
+            elif rtype == RType.GPU:
+                gpus += [value]
+        return [len(cores), max(cores, default=0), ram,
+                len(gpus), max(gpus, default=0)]
+
+    @classmethod
+    def _freeSummary(cls, machine):
+        return cls.summary((res.rtype, res.value)
+                           for res in machine.resources if res.value > 0)
+
+    @staticmethod
+    def requestSummary(resHolder):
+        """
+        Returns row of amounts necessary (but not always sufficient)
+        to fit `resHolder`, comparable with rows of the matrices.
+        """
+        counts = {RType.CPU_core: [0, 0], RType.GPU: [0, 0]}
+        largest = {RType.CPU_core: 0, RType.GPU: 0}
+        ram = 0
+        for req in resHolder.resourceRequest:
+            if req.rtype in counts:
+                counts[req.rtype][0] += 1
+                if req.shared:
+                    continue
+                if req.value == INF:
+                    counts[req.rtype][1] += 1
+                else:
+                    largest[req.rtype] = max(largest[req.rtype], req.value)
+            elif req.rtype == RType.RAM and not req.shared \
+                    and req.value != INF:
+                ram += req.value
+        noCores = max(min(1, counts[RType.CPU_core][0]),
+                      counts[RType.CPU_core][1])
+        noGPUs = max(min(1, counts[RType.GPU][0]), counts[RType.GPU][1])
+        return [noCores, largest[RType.CPU_core], ram,
+                noGPUs, largest[RType.GPU]]
+
+    def update(self, machine):
+        """
+        Marks free amounts of `machine` outdated.
+        """
+        self._outdated.add(machine)
+
+    def feasibleMask(self, resHolder, free=False):
+        """
+        Returns boolean np.array over `self.machines`.
+        By default it marks exactly the machines for which `isFittable`
+        holds. With `free` it is computed from the free amounts only,
+        so it is a cheap necessary condition for `canAllocate`.
+        """
+        need = np.array(self.requestSummary(resHolder), dtype=float)
+        matrix = self.free if free else self.capacities
+        mask = np.all(matrix >= need, axis=1)
+        if free:
+            return mask
+        candidates = np.unique(self._classOf[mask])
+        fits = np.zeros(len(self._representatives), dtype=bool)
+        for c in candidates:
+            fits[c] = self._representatives[c].isFittable(resHolder)
+        return fits[self._classOf]
+
+
+
+class ResourcesIndex:
+    """
+    Resources of a machine with positive value, ordered separately
+    for each resource type by value, by value among these not used
+    dynamically, and by the share each new dynamic user would get.
+    Ties are resolved by position of the resource in machine's
+    resources, the same as in scanning them in order.
+    Resources update the index before and after each change.
+    """
+    def __init__(self, resources):
+        self._resources = list(resources)
+        self._build()
+        for res in self._resources:
+            res._indexes += [self]
+
+    def _build(self):
+        pos = {}
+        for i, res in enumerate(self._resources):
+            pos[res] = i
+        self._byValue = {}     # {rtype: [res]} by (value, pos)
+        self._freeByValue = {} # {rtype: [res]} by (value, -pos)
+        self._byShare = {}     # {rtype: [res]} by (share, -pos)
+        for res in self._resources:
+            if res.rtype in self._byValue:
+                continue
+            self._byValue[res.rtype] = SortedKeyList(
+                key=lambda r: (r.value, pos[r]))
+            self._freeByValue[res.rtype] = SortedKeyList(
+                key=lambda r: (r.value, -pos[r]))
+            self._byShare[res.rtype] = SortedKeyList(
+                key=lambda r: (self.share(r), -pos[r]))
+        for res in self._resources:
+            self.add(res)
+
+    def __getstate__(self):
+        # sorted lists would call keys on resources not unpickled yet,
+        # they are rebuilt on first use instead
+        return {'_resources': self._resources}
+
+    def __setstate__(self, state):
+        self._resources = state['_resources']
+        self._byValue = None
+
+    @staticmethod
+    def share(res):
+        return res.maxValue/(1 + res.noDynamicUses + res.noVMsUsing)
+
+    def add(self, res):
+        if res.value <= 0 or self._byValue is None:
+            return
+        self._byValue[res.rtype].add(res)
+        self._byShare[res.rtype].add(res)
+        if res.noDynamicUses == 0:
+            self._freeByValue[res.rtype].add(res)
+
+    def remove(self, res):
+        if res.value <= 0 or self._byValue is None:
+            return
+        self._byValue[res.rtype].remove(res)
+        self._byShare[res.rtype].remove(res)
+        if res.noDynamicUses == 0:
+            self._freeByValue[res.rtype].remove(res)
+
+    def getBestFitting(self, req):
+        if self._byValue is None:
+            self._build()
+        if len(self._byValue.get(req.rtype, [])) == 0:
+            raise RuntimeError(f"Cannot find fitting {req.rtype}")
+        if req.shared:
+            return self._byShare[req.rtype][-1]
+        elif req.value == INF:
+            allRes = self._freeByValue[req.rtype]
+            if len(allRes) == 0:
+                raise RuntimeError(f"Cannot find fitting {req.rtype}")
+            return allRes[-1]
+        else:
+            allRes = self._byValue[req.rtype]
+            idx = allRes.bisect_key_left((req.value, -1))
+            if idx < len(allRes):
+                return allRes[idx]
+        raise RuntimeError(f"Cannot find fitting {req.rtype}")
+
+
+
+class AllocationTransaction:
+    """
+    Allocation of resources requested by holder on a machine.
+    Recalculation of jobs using witheld resources is postponed
+    to `commit`, while `rollback` restores previous state
+    of the resources without any recalculation.
+    """
+    def __init__(self, machine, resHolder):
+        self.machine = machine
+        self.resHolder = resHolder
+        self._snapshots = {} # {srcRes: snapshot}, ordered by last withold
+
+    def withold(self, req):
+        srcRes = self.machine.getBestFitting(req)
+        if srcRes in self._snapshots:
+            snapshot = self._snapshots.pop(srcRes)
+        else:
+            snapshot = srcRes.snapshot()
+        self._snapshots[srcRes] = snapshot
+        dstRes = srcRes.withold(req, recalculate=False)
+        assert dstRes.value > 0
+        self.resHolder._resourceRequest[req] = (srcRes, dstRes)
+        srcRes.addUser(self.resHolder, dstRes)
+
+    def witholdAll(self):
+        requests = self.resHolder.resourceRequest
+        for req in filter(lambda r: not r.shared, requests):
+            self.withold(req)
+        for req in filter(lambda r: r.shared, requests):
+            self.withold(req)
+
+    def commit(self):
+        for srcRes in self._snapshots:
+            srcRes.recalculateJobs()
+        self._snapshots = {}
+
+    def rollback(self):
+        for req, x in self.resHolder._resourceRequest.items():
+            if x is None:
+                continue
+            (srcRes, dstRes) = x
+            srcRes.delUser(self.resHolder, dstRes)
+            self.resHolder._resourceRequest[req] = None
+        for srcRes, snapshot in self._snapshots.items():
+            srcRes.restore(snapshot)
+        self._snapshots = {}
+
+
+
+class Machine(UsersTracker):
     """
     Hardware machine, that holds resources and is able
     to run jobs or host virtual machines.
     """
-    _noCreated = 0
+    _indices = itertools.count()
 
     def __init__(self, name, resources,
                  getJobScheduler=lambda _: None,
                  getVMScheduler=lambda _: None):
-        self._index = Machine._noCreated
+        UsersTracker.__init__(self)
+        self._index = next(Machine._indices)
         self.name = name
         self._resources = resources
+        self._resourcesIndex = ResourcesIndex(resources)
+        self._capacityClass = None
+        self._capacityMatrix = None
         self._jobScheduler = getJobScheduler(self)
         self._vmScheduler = getVMScheduler(self)
-        Machine._noCreated += 1
-        self._users = {}
-
-    def addUser(self, user):
-        if type(user) not in self._users.keys():
-            self._users[type(user)] = Multiset()
-        self._users[type(user)].add(user)
-
-    def delUser(self, user):
-        self._users[type(user)].remove(user, 1)
-        if len(self._users[type(user)]) == 0:
-            del self._users[type(user)]
-
-    @property
-    def jobsUsing(self):
-        for key, val in self._users.items():
-            if str(key) == "<class 'Job.Job'>":
-                return set(val)
-        return set()
-
-    @property
-    def vmsUsing(self):
-        for key, val in self._users.items():
-            if str(key) == "<class 'Machine.VirtualMachine'>":
-                return set(val)
-        return set()
 
     @property
     def resources(self):
@@ -75,12 +361,14 @@ class Machine:
             yield (res.rtype, res.maxValue)
 
     def getBestFitting(self, req):
+        if self._resourcesIndex is not None:
+            return self._resourcesIndex.getBestFitting(req)
         f = lambda r: r.rtype == req.rtype and r.value > 0
         allRes = list(filter(f, self.resources))
         if len(allRes) == 0:
             raise RuntimeError(f"Cannot find fitting {req.rtype}")
         if req.shared:
-            f = lambda r: r.maxValue/(1 + r.noDynamicUses + len(r.vmsUsing))
+            f = lambda r: r.maxValue/(1 + r.noDynamicUses + r.noVMsUsing)
             return max(allRes, key=f)
         elif req.value == INF:
             allRes = list(filter(lambda r: r.noDynamicUses == 0, allRes))
@@ -97,54 +385,60 @@ class Machine:
     def allocate(self, resHolder, noexcept=False):
         if resHolder.isAllocated:
             raise Exception(f"{resHolder.name} is already allocated")
-        #  reqResMap = {}
+        transaction = AllocationTransaction(self, resHolder)
         try:
-            for req in filter(lambda r: not r.shared, resHolder.resourceRequest):
-                srcRes = self.getBestFitting(req)
-                dstRes = srcRes.withold(req)
-                assert dstRes.value > 0
-                #  reqResMap[req] = (srcRes, dstRes)
-                resHolder._resourceRequest[req] = (srcRes, dstRes)
-                srcRes.addUser(resHolder)
-            for req in filter(lambda r: r.shared, resHolder.resourceRequest):
-                srcRes = self.getBestFitting(req)
-                dstRes = srcRes.withold(req)
-                assert dstRes.value > 0
-                #  reqResMap[req] = (srcRes, dstRes)
-                resHolder._resourceRequest[req] = (srcRes, dstRes)
-                srcRes.addUser(resHolder)
+            transaction.witholdAll()
         except RuntimeError:
-            #  for srcRes, dstRes in reqResMap.values():
-            for req, x in resHolder._resourceRequest.items():
-                if x is None:
-                    continue
-                (srcRes, dstRes) = x
-                srcRes.release(dstRes)
-                srcRes.delUser(resHolder)
-                resHolder._resourceRequest[req] = None
+            transaction.rollback()
             if noexcept:
                 return False
             raise RuntimeError(f"Resources allocation for {resHolder.name} "
                                f"on {self.name} failed")
         assert resHolder.isAllocated == 1
-        #  job.setResources(reqResMap)
         self.addUser(resHolder)
+        transaction.commit()
+        if self._capacityMatrix is not None:
+            self._capacityMatrix.update(self)
         resHolder.setHost(self)
         return True
 
+    def canAllocate(self, resHolder):
+        """
+        Checks if `resHolder` could be allocated now,
+        without changing state of any resource.
+        """
+        if resHolder.isAllocated:
+            raise Exception(f"{resHolder.name} is already allocated")
+        transaction = AllocationTransaction(self, resHolder)
+        try:
+            transaction.witholdAll()
+        except RuntimeError:
+            return False
+        finally:
+            transaction.rollback()
+        return True
+
     def free(self, resHolder):
         resHolder.unsetHost()
-        if type(resHolder) not in self._users.keys() or \
-           resHolder not in self._users[type(resHolder)]:
+        if not self.isUsedBy(resHolder):
             raise Exception(f"{resHolder.name} is not allocated on this machine")
         for srcRes, dstRes in resHolder.unsetResources():
             assert srcRes in self.resources
+            # request is already unset, so it is not counted
+            # as dynamic use while releasing
+            srcRes.delUser(resHolder, dstRes)
             srcRes.release(dstRes)
-            srcRes.delUser(resHolder)
         assert resHolder.isAllocated == 0
         self.delUser(resHolder)
+        if self._capacityMatrix is not None:
+            self._capacityMatrix.update(self)
 
     def isFittable(self, resHolder):
+        if self._capacityClass is not None:
+            return self._capacityClass.isFittable(resHolder)
+        return self._checkFittable(resHolder)
+
+    def _checkFittable(self, resHolder):
         resources = {}
         for rtype, value in self.maxResources:
             if rtype not in resources.keys():
@@ -195,6 +489,18 @@ class Machine:
     def __hash__(self):
         return self._index
 
+    def __reduce__(self):
+        # machines are hashed (e.g. as keys of `CapacityMatrix._rows`)
+        # before their state is unpickled, so index is restored first
+        return (_restoreMachine, (type(self), self._index), self.__dict__)
+
+
+
+def _restoreMachine(cls, index):
+    machine = cls.__new__(cls)
+    machine._index = index
+    return machine
+
 
 
 class VirtualMachine(Machine, ResourcesHolder):
@@ -202,11 +508,15 @@ class VirtualMachine(Machine, ResourcesHolder):
     Machine, that could be allocated on other machines,
     ald use part of it's resources to run jobs.
     """
+    _userKind = 'vm'
+
     def __init__(self, name, resourceRequest={},
                  getJobScheduler=lambda _: None,
                  getVMScheduler=lambda _: None):
         Machine.__init__(self, name, [], getJobScheduler, getVMScheduler)
         ResourcesHolder.__init__(self, resourceRequest)
+        # resources of virtual machine change with its allocation
+        self._resourcesIndex = None
         self._srcResMap = {}
         #  self.resourceRequest = resourceRequest
 
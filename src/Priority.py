@@ -0,0 +1,166 @@
+import numpy as np
+
+
+class Priority:
+    """
+    Priority of a job as a function of time.
+    Unlike arbitrary callables (which are still accepted wherever
+    priority is expected), priority objects can be evaluated in bulk,
+    integrated in closed form and linear ones could be ordered
+    without evaluation.
+    """
+
+    def __call__(self, t):
+        raise NotImplementedError()
+
+    @property
+    def coefficients(self):
+        """
+        Returns (slope, intercept) if priority is linear, None otherwise.
+        """
+        return None
+
+    def shifted(self, time):
+        """
+        Returns priority 'starting' at `time` instead of in 0.
+        """
+        return ShiftedPriority(self, time)
+
+    def integral(self, t0, t1):
+        return (t1 - t0)*(self(t1) + self(t0))/2
+
+    @staticmethod
+    def shift(priority, time):
+        """
+        Shifts any priority, also plain callable, by `time`.
+        """
+        if isinstance(priority, Priority):
+            return priority.shifted(time)
+        return ShiftedPriority(priority, time)
+
+    @staticmethod
+    def evaluate(priorities, times):
+        """
+        Returns np.array of `priorities[i](times[i])`, or of all
+        priorities at the same time if `times` is a number.
+        Linear priorities are evaluated with array operations.
+        """
+        n = len(priorities)
+        times = np.broadcast_to(np.asarray(times, dtype=float), (n,))
+        result = np.empty(n)
+        linear = np.zeros(n, dtype=bool)
+        a, b, shift = np.zeros(n), np.zeros(n), np.zeros(n)
+        for i, priority in enumerate(priorities):
+            if type(priority) is LinearPriority:
+                linear[i] = True
+                a[i], b[i], shift[i] = priority.a, priority.b, priority.shift
+            elif type(priority) is ConstantPriority:
+                result[i] = priority.value
+            else:
+                result[i] = priority(times[i])
+        result[linear] = a[linear]*(times[linear] - shift[linear]) + b[linear]
+        return result
+
+    @staticmethod
+    def integrate(priorities, t0, t1):
+        """
+        Returns np.array of integrals of `priorities[i]` from `t0[i]`
+        to `t1[i]`. Plain callables are assumed to be linear.
+        """
+        t0 = np.asarray(t0, dtype=float)
+        t1 = np.asarray(t1, dtype=float)
+        p0 = Priority.evaluate(priorities, t0)
+        p1 = Priority.evaluate(priorities, t1)
+        result = (t1 - t0)*(p1 + p0)/2
+        for i, priority in enumerate(priorities):
+            if isinstance(priority, Priority) and \
+               priority.coefficients is None:
+                result[i] = priority.integral(t0[i], t1[i])
+        return result
+
+
+
+class ConstantPriority(Priority):
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, t):
+        return self.value
+
+    @property
+    def coefficients(self):
+        return 0, self.value
+
+    def shifted(self, time):
+        return self
+
+
+
+class LinearPriority(Priority):
+    """
+    Priority `a*(t - shift) + b` changing linearly in time.
+    """
+
+    def __init__(self, a, b, shift=0):
+        self.a = a
+        self.b = b
+        self.shift = shift
+
+    def __call__(self, t):
+        return self.a*(t - self.shift) + self.b
+
+    @property
+    def coefficients(self):
+        return self.a, self.b - self.a*self.shift
+
+    def shifted(self, time):
+        return LinearPriority(self.a, self.b, self.shift + time)
+
+
+
+class PiecewiseLinearPriority(Priority):
+    """
+    Priority interpolated linearly between (time, value) points,
+    constant before the first and after the last one.
+    """
+
+    def __init__(self, points):
+        points = sorted(points)
+        self.times = np.array([t for t, _ in points], dtype=float)
+        self.values = np.array([v for _, v in points], dtype=float)
+
+    def __call__(self, t):
+        return np.interp(t, self.times, self.values)
+
+    def integral(self, t0, t1):
+        inner = self.times[(self.times > t0) & (self.times < t1)]
+        xs = np.concatenate(([t0], inner, [t1]))
+        ys = self(xs)
+        return np.sum((xs[1:] - xs[:-1])*(ys[1:] + ys[:-1])/2)
+
+
+
+class ShiftedPriority(Priority):
+    """
+    Priority `priority(t - shift)` for any priority callable.
+    """
+
+    def __init__(self, priority, shift):
+        self.priority = priority
+        self.shift = shift
+
+    def __call__(self, t):
+        return self.priority(t - self.shift)
+
+    @property
+    def coefficients(self):
+        coefficients = getattr(self.priority, 'coefficients', None)
+        if coefficients is None:
+            return None
+        a, b = coefficients
+        return a, b - a*self.shift
+
+    def integral(self, t0, t1):
+        if isinstance(self.priority, Priority):
+            return self.priority.integral(t0 - self.shift, t1 - self.shift)
+        return super().integral(t0, t1)
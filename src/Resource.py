@@ -16,7 +16,46 @@ class ResourceRequest:
 
 
 
-class Resource:
+class UsersTracker:
+    """
+    Keeps track of jobs and virtual machines using an object,
+    with number of times each of them has been added.
+    """
+    def __init__(self):
+        self._users = {None: {}, 'job': {}, 'vm': {}} # {kind: {user: n}}
+
+    def addUser(self, user):
+        users = self._users[user._userKind]
+        users[user] = users.get(user, 0) + 1
+
+    def delUser(self, user):
+        users = self._users[user._userKind]
+        users[user] -= 1
+        if users[user] == 0:
+            del users[user]
+
+    def isUsedBy(self, user):
+        return user in self._users[user._userKind]
+
+    @property
+    def jobsUsing(self):
+        return set(self._users['job'])
+
+    @property
+    def vmsUsing(self):
+        return set(self._users['vm'])
+
+    @property
+    def noJobsUsing(self):
+        return len(self._users['job'])
+
+    @property
+    def noVMsUsing(self):
+        return len(self._users['vm'])
+
+
+
+class Resource(UsersTracker):
     """
     Bisic resource class. Represents it's type and values
     (max possible and current), and provides information about
@@ -38,11 +77,13 @@ class Resource:
 
 
     def __init__(self, rtype, value, freq=None):
+        super().__init__()
         self.rtype = rtype 
         self.maxValue = value
         self.tmpMaxValue = value
         self.value = value
-        self._users = {}
+        self._noDynamicUses = 0
+        self._indexes = [] # indexes ordering this resource by its state
         if rtype is self.Type.CPU_core and freq is None:
             freq = 1
         if rtype is self.Type.RAM:
@@ -51,29 +92,31 @@ class Resource:
             assert freq is not None
         self.freq = freq
 
-    def addUser(self, user):
-        if type(user) not in self._users.keys():
-            self._users[type(user)] = Multiset()
-        self._users[type(user)].add(user)
-
-    def delUser(self, user):
-        self._users[type(user)].remove(user, 1)
-        if len(self._users[type(user)]) == 0:
-            del self._users[type(user)]
-
-    @property
-    def jobsUsing(self):
-        for key, val in self._users.items():
-            if str(key) == "<class 'Job.Job'>":
-                return set(val)
-        return set()
-
-    @property
-    def vmsUsing(self):
-        for key, val in self._users.items():
-            if str(key) == "<class 'Machine.VirtualMachine'>":
-                return set(val)
-        return set()
+    def addUser(self, user, dstRes=None):
+        """
+        Registers `user` of this resource, that obtained `dstRes`
+        from it. Job obtaining the resource itself uses it dynamically.
+        """
+        self._unindex()
+        super().addUser(user)
+        if dstRes is self and user._userKind == 'job':
+            self._noDynamicUses += 1
+        self._reindex()
+
+    def delUser(self, user, dstRes=None):
+        self._unindex()
+        super().delUser(user)
+        if dstRes is self and user._userKind == 'job':
+            self._noDynamicUses -= 1
+        self._reindex()
+
+    def _unindex(self):
+        for index in self._indexes:
+            index.remove(self)
+
+    def _reindex(self):
+        for index in self._indexes:
+            index.add(self)
 
     @property
     def avaliableValue(self):
@@ -81,49 +124,57 @@ class Resource:
 
     @property
     def noDynamicUses(self):
-        noDynamic = 0
-        for job in self.jobsUsing:
-            for req, x in job._resourceRequest.items():
-                if x is None:
-                    continue
-                (srcRes, dstRes) = x
-                noDynamic += dstRes is self
-        return noDynamic
-
-    def withold(self, req):
+        return self._noDynamicUses
+
+    def snapshot(self):
+        return (self.value, self.tmpMaxValue)
+
+    def restore(self, snapshot):
+        self._unindex()
+        self.value, self.tmpMaxValue = snapshot
+        self._reindex()
+
+    def withold(self, req, recalculate=True):
         resource = None
         if req.shared:
+            self._unindex()
             self.value = self.tmpMaxValue / (self.noDynamicUses + 1)
+            self._reindex()
             resource = self
         else:
-            value = self.tmpMaxValue if req.value is INF else req.value
+            value = self.tmpMaxValue if req.value == INF else req.value
             if value > self.tmpMaxValue:
                 raise RuntimeError(f"Requested {value} out of {self.value} avaliable")
+            self._unindex()
             self.tmpMaxValue -= value
             self.value = self.tmpMaxValue / max(self.noDynamicUses, 1)
+            self._reindex()
             resource = Resource(self.rtype, value, self.freq)
-        self.recalculateJobs()
+        if recalculate:
+            self.recalculateJobs()
         return resource
 
     def release(self, resource):
+        if resource is not self and \
+           self.tmpMaxValue + resource.value > self.maxValue + EPS:
+            raise RuntimeError("Resource overflow after release")
+        self._unindex()
         if resource is self:
             self.value = self.tmpMaxValue / max(1, self.noDynamicUses - 1)
-        elif self.tmpMaxValue + resource.value > self.maxValue + EPS:
-            raise RuntimeError("Resource overflow after release")
         else:
             self.tmpMaxValue = min(self.tmpMaxValue + resource.value, self.maxValue)
             self.value = self.tmpMaxValue / max(self.noDynamicUses, 1)
+        self._reindex()
         self.recalculateJobs()
 
     def recalculateJobs(self):
-        now = Simulator.getInstance().time
-        for job in self.jobsUsing:
+        # marking jobs does not change users, no copy is needed
+        for job in self._users['job']:
             if job.host is None:
                 continue
             if all([v < EPS for v in job.operationsLeft.values()]):
                 continue
-            jobRecalculate = JobRecalculate(job, job.host)
-            Simulator.getInstance().addEvent(now, jobRecalculate)
+            JobsRecalculate.markDirty(job)
 
     def __lt__(self, other):
         if self.rtype != other.rtype:
@@ -139,6 +190,8 @@ RType = Resource.Type
 
 
 class ResourcesHolder:
+    _userKind = None
+
     def __init__(self, resourceRequest):
         self._resourceRequest = {} # {req: (srcRes, dstRes)}
         for req in resourceRequest:
@@ -1,3 +1,7 @@
+import heapq
+import itertools
+import threading
+from collections import deque
 from enum import Enum
 from sortedcontainers import SortedDict, SortedSet
 from toolkit import MultiDictRevDict
@@ -9,16 +13,16 @@ class Event:
     Simple 0-argument function wrapper.
     Basic Event executed by Simulator.
     """
-    _noCreated = 0
+    # next() of count is atomic, unlike `+= 1` on class attribute
+    _indices = itertools.count()
 
     def __init__(self, f, name=None, priority=0):
         self._f = f
-        self._index = Event._noCreated
+        self._index = next(Event._indices)
         if (name is None):
             name = f"Event_{self._index}"
         self.name = name
         self._priority = priority
-        Event._noCreated += 1
 
     def proceed(self):
         self._f()
@@ -45,6 +49,8 @@ class Notification:
         JobFinish = 5
         Other = 0
 
+    Keys = ('host', 'vm', 'job', 'message')
+
     def __init__(self, what, time='now', **kwargs):
         self.time = NOW() if time == 'now' else time
         self.what = what
@@ -56,6 +62,11 @@ NType = Notification.Type
 
 
 class NotificationListener(metaclass=ABCMeta):
+    """
+    Listener is notified about every emitted notification,
+    unless it subscribes for specific ones. Then it gets only
+    notifications matching any of its subscriptions.
+    """
     def __new__(cls, *args, **kwargs):
         obj = super(NotificationListener, cls).__new__(cls)
         Simulator.getInstance().registerListener(obj)
@@ -65,28 +76,152 @@ class NotificationListener(metaclass=ABCMeta):
     def notify(self, event):
         pass
 
+    def subscribe(self, what, **key):
+        """
+        Subscribe for notifications of type `what`,
+        optionally only these with given value of one of
+        `host`, `vm`, `job` or `message` attributes.
+        """
+        Simulator.getInstance().subscribe(self, what, **key)
+
     def unregister(self):
         Simulator.getInstance().unregisterListener(self)
 
 
+class EventHistory:
+    """
+    Policy of storing already executed events.
+    This base one does not store anything,
+    so memory usage does not grow with simulation length.
+    """
+    def __init__(self):
+        self._noAdded = 0
+
+    def add(self, time, event):
+        self._noAdded += 1
+
+    def __len__(self):
+        return 0
+
+    def __iter__(self):
+        return iter([])
+
+    def clear(self):
+        self._noAdded = 0
+
+    def close(self):
+        pass
+
+
+
+class ListEventHistory(EventHistory):
+    """
+    Stores all executed events in list [(time_executed, event)].
+    """
+    def __init__(self):
+        super().__init__()
+        self._events = []
+
+    def add(self, time, event):
+        super().add(time, event)
+        self._events += [(time, event)]
+
+    def __len__(self):
+        return len(self._events)
+
+    def __iter__(self):
+        return iter(self._events)
+
+    def __getitem__(self, idx):
+        return self._events[idx]
+
+    def clear(self):
+        super().clear()
+        self._events = []
+
+
+
+class RingEventHistory(ListEventHistory):
+    """
+    Stores only `size` most recently executed events.
+    """
+    def __init__(self, size):
+        super().__init__()
+        self._events = deque(maxlen=size)
+
+    def add(self, time, event):
+        self._noAdded += 1
+        self._events.append((time, event))
+
+    def clear(self):
+        self._noAdded = 0
+        self._events.clear()
+
+
+
+class FileEventHistory(EventHistory):
+    """
+    Streams executed events to text file, one
+    `time event_name` line per event, through buffered writer.
+    Event objects are not referenced after being written.
+    """
+    def __init__(self, fname, bufferSize=1<<16):
+        super().__init__()
+        self.fname = fname
+        self._bufferSize = bufferSize
+        self._file = open(fname, 'w', buffering=bufferSize)
+
+    def add(self, time, event):
+        super().add(time, event)
+        self._file.write(f"{time} {event.name}\n")
+
+    def __len__(self):
+        return self._noAdded
+
+    def __iter__(self):
+        self._file.flush()
+        with open(self.fname, 'r') as file:
+            for line in file:
+                time, name = line.rstrip('\n').split(' ', 1)
+                yield (float(time), name)
+
+    def clear(self):
+        super().clear()
+        self._file.seek(0)
+        self._file.truncate()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+
 class Simulator:
     """
-    Singleton, the main Simulator class.
+    The main Simulator class. Each instance is a separate simulation
+    context, owning its own clock, event queue and listeners.
     Responsible for running simulation.
     Supports adding and removing future events."
+
+    Modules reach the simulation through `Simulator.getInstance()`,
+    which returns the current simulator of the calling thread.
+    Another simulator is made current with `with sim: ...`,
+    so independent simulations may run in separate threads
+    or processes without sharing any state.
     """
     class EventQueue:
         """
         Queue of future events stored in MultiDictRevDict structure.
-        Stores past events in list [(time_executed, event)].
+        Stores past events according to given EventHistory
+        (by default does not store them at all).
         Supports adding and removing future events,
         and porceeding the most recent one.
 
         """
-        def __init__(self):
+        def __init__(self, history=None):
             self._currentTime = 0
             self._todo = MultiDictRevDict()
-            self._done = []
+            self._done = EventHistory() if history is None else history
 
         def __len__(self):
             return len(self._todo)
@@ -95,8 +230,8 @@ class Simulator:
             time, event = self._todo.popitem()
             self._currentTime = time
             event.proceed()
-            self._done += [(time, event)]
-            return self._done[-1]
+            self._done.add(time, event)
+            return (time, event)
 
         def addEvent(self, time, event):
             self._todo[time] = event
@@ -107,59 +242,225 @@ class Simulator:
         def clear(self):
             self._currentTime = 0
             self._todo.clear()
-            self._done = []
+            self._done.clear()
 
 
-    __self = None
+    class HeapEventQueue(EventQueue):
+        """
+        Queue of future events stored in binary heap of
+        [time, -priority, index, event] entries, which gives
+        the same order as Event.__lt__ without calling it.
+        Removed events are only marked as deleted (tombstones)
+        and skipped when popped. Heap is rebuilt without them
+        when they make up more than half of it.
+        """
+        def __init__(self, history=None, compactionLimit=1024):
+            super().__init__(history)
+            self._todo = {} # {event: entry}
+            self._heap = []
+            self._noRemoved = 0
+            self._compactionLimit = compactionLimit
 
-    def __init__(self):
-        if Simulator.__self != None:
-            raise Exception("Creating another instance of Simulator is forbidden")
-        self._listeners = set()
+        def proceed(self):
+            while True:
+                time, _, _, event = heapq.heappop(self._heap)
+                if event is not None:
+                    break
+                self._noRemoved -= 1
+            del self._todo[event]
+            self._currentTime = time
+            event.proceed()
+            self._done.add(time, event)
+            return (time, event)
+
+        def addEvent(self, time, event):
+            if event in self._todo:
+                raise RuntimeError("value already present")
+            entry = [time, -event._priority, event._index, event]
+            self._todo[event] = entry
+            heapq.heappush(self._heap, entry)
+
+        def removeEvent(self, event):
+            entry = self._todo.pop(event)
+            entry[-1] = None
+            self._noRemoved += 1
+            if self._noRemoved > self._compactionLimit and \
+               2*self._noRemoved > len(self._heap):
+                self._compact()
+
+        def _compact(self):
+            self._heap = [e for e in self._heap if e[-1] is not None]
+            heapq.heapify(self._heap)
+            self._noRemoved = 0
+
+        def clear(self):
+            super().clear()
+            self._heap = []
+            self._noRemoved = 0
+
+
+    _local = threading.local()
+
+    def __init__(self, EventQueueClass=None, history=None):
+        if EventQueueClass is None:
+            EventQueueClass = Simulator.EventQueue
+        # dicts of {listener: None} keep order of registration
+        self._listeners = {} # notified about everything
+        self._subscribers = {} # {(what, key, value): {listener: None}}
+        self._subscriptions = {} # {listener: [(what, key, value)]}
         self._to_unregister = set()
-        self._eventQueue = Simulator.EventQueue()
-        Simulator.__self = self
-        
+        self._eventQueue = EventQueueClass(history)
+        self._recalculation = None # pending JobsRecalculate event
+        self._running = False # started and not finished
+
+    @staticmethod
+    def _contexts():
+        """
+        Stack of simulators activated in the calling thread.
+        """
+        if not hasattr(Simulator._local, 'stack'):
+            Simulator._local.stack = []
+        return Simulator._local.stack
+
     @staticmethod
     def getInstance(*args, **kwargs):
-        if Simulator.__self == None:
-            Simulator(*args, **kwargs)
-        return Simulator.__self;
+        contexts = Simulator._contexts()
+        if len(contexts) == 0:
+            contexts.append(Simulator(*args, **kwargs))
+        return contexts[-1]
+
+    def __enter__(self):
+        Simulator._contexts().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        contexts = Simulator._contexts()
+        if len(contexts) > 0 and contexts[-1] is self:
+            contexts.pop()
     
     @property
     def time(self):
         return self._eventQueue._currentTime
 
-    def simulate(self):
-        self.emit(Notification(NType.Other, message="SimulationStart"))
-        while len(self._eventQueue) > 0:
-            time, event = self._eventQueue.proceed()
+    def simulate(self, until=None):
+        """
+        Proceeds events until none is left, or until `until()`
+        is true after some event. Returns whether simulation
+        has finished; stopped one is resumed by calling it again.
+        """
+        with self:
+            if not self._running:
+                self._running = True
+                self.emit(Notification(NType.Other, message="SimulationStart"))
+            while len(self._eventQueue) > 0:
+                time, event = self._eventQueue.proceed()
+                if until is not None and until():
+                    return False
+            self._running = False
+            return True
 
     def emit(self, notification):
         self.updateListeners()
-        for listener in self._listeners:
+        what = notification.what
+        # listener matching many subscriptions is notified once
+        targets = dict(self._listeners)
+        targets.update(self._subscribers.get((what, None, None), {}))
+        for key in Notification.Keys:
+            value = getattr(notification, key, None)
+            if value is not None:
+                targets.update(self._subscribers.get((what, key, value), {}))
+        for listener in targets:
             listener.notify(notification)
     
+    def setEventQueue(self, EventQueueClass):
+        if len(self._eventQueue) > 0:
+            raise Exception("Cannot change queue with pending events")
+        time = self._eventQueue._currentTime
+        self._eventQueue = EventQueueClass(self._eventQueue._done)
+        self._eventQueue._currentTime = time
+
+    @property
+    def history(self):
+        return self._eventQueue._done
+
+    def setHistory(self, history):
+        self._eventQueue._done.close()
+        self._eventQueue._done = history
+
     def addEvent(self, time, event):
         self._eventQueue.addEvent(time, event)
 
     def removeEvent(self, event):
         self._eventQueue.removeEvent(event)
 
+    def pendingRecalculation(self, EventClass):
+        """
+        Returns recalculation event pending at the current time,
+        adding a new `EventClass()` one if there is none.
+        """
+        if self._recalculation is None:
+            self._recalculation = EventClass()
+            self.addEvent(self.time, self._recalculation)
+        return self._recalculation
+
+    def recalculationStarted(self):
+        """
+        Called by the pending recalculation event when proceeded,
+        so that later changes add a new one.
+        """
+        self._recalculation = None
+
     def registerListener(self, listener):
-        self._listeners.add(listener)
+        self._listeners[listener] = None
+
+    def subscribe(self, listener, what, **key):
+        if len(key) > 1:
+            raise Exception("Subscription may be narrowed by one key only")
+        key, value = list(key.items())[0] if len(key) > 0 else (None, None)
+        if key is not None and key not in Notification.Keys:
+            raise Exception(f"Cannot subscribe by '{key}'")
+        self._listeners.pop(listener, None)
+        subscription = (what, key, value)
+        if subscription not in self._subscribers:
+            self._subscribers[subscription] = {}
+        self._subscribers[subscription][listener] = None
+        if listener not in self._subscriptions:
+            self._subscriptions[listener] = []
+        self._subscriptions[listener] += [subscription]
 
     def unregisterListener(self, listener):
         self._to_unregister.add(listener)
 
     def updateListeners(self):
-        self._listeners = self._listeners.difference(self._to_unregister)
+        if len(self._to_unregister) == 0:
+            return
+        for listener in self._to_unregister:
+            self._listeners.pop(listener, None)
+            for subscription in self._subscriptions.pop(listener, []):
+                subscribers = self._subscribers[subscription]
+                subscribers.pop(listener, None)
+                if len(subscribers) == 0:
+                    del self._subscribers[subscription]
         self._to_unregister = set()
 
     def clear(self):
-        self._listeners = []
+        self._listeners = {}
+        self._subscribers = {}
+        self._subscriptions = {}
         self._eventQueue.clear()
-        Simulator.__self = None
+        self._recalculation = None
+        self._running = False
+        contexts = Simulator._contexts()
+        if self in contexts:
+            contexts.remove(self)
+
+    def close(self):
+        """
+        Clears simulation and releases its history (e.g. closes file
+        of `FileEventHistory`). Cleared one may be reused, closed not.
+        """
+        self.clear()
+        self._eventQueue._done.close()
 
 
 def NOW():
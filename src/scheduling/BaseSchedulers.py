@@ -11,6 +11,12 @@ class VMSchedulerSimple(NotificationListener):
         self._machine = machine
         self._vmQueue = []
         self._suspended = False
+        self._features = {} # {policy: feature store following the queue}
+        self.subscribe(NType.VMStart, host=machine)
+        self.subscribe(NType.VMEnd, host=machine)
+        self.subscribe(NType.Other, message="SimulationStart")
+        self.subscribe(NType.Other, message="VMSchedule")
+        self.subscribe(NType.Other, message="VMPlacement")
 
     @property
     def noVMsLeft(self):
@@ -26,7 +32,17 @@ class VMSchedulerSimple(NotificationListener):
         return self._vmQueue[0]
 
     def popFront(self):
-        return self._vmQueue.pop(0)
+        vm = self._vmQueue.pop(0)
+        self._dequeued(vm)
+        return vm
+
+    def _enqueued(self, vm):
+        for features in self._features.values():
+            features.add(self._machine, vm)
+
+    def _dequeued(self, vm):
+        for features in self._features.values():
+            features.remove(self._machine, vm)
 
     def _tryAllocate(self):
         if self.head() is None:
@@ -50,6 +66,7 @@ class VMSchedulerSimple(NotificationListener):
             raise Exception(f"{vm.name} can never be allocated"
                             f" on {self._machine.name}")
         self._vmQueue += [vm]
+        self._enqueued(vm)
 
     def notify(self, notif):
         if self._suspended:
@@ -61,7 +78,7 @@ class VMSchedulerSimple(NotificationListener):
            notif.host == self._machine:
             self._tryAllocate()
         if notif.what == NType.Other and \
-           (notif.message == "SimulationStart" or notif.message == "VMSchedule"):
+           notif.message in ("SimulationStart", "VMSchedule", "VMPlacement"):
             self._tryAllocate()
 
 
@@ -73,12 +90,15 @@ class VMPlacementPolicySimple:
         for machine in machines:
             self._schedulers[machine] = machine._vmScheduler
             self._machines.add(0, machine)
+        self._capacities = CapacityMatrix.shared(machines)
+        self._rows = {m: i for i, m in enumerate(self._capacities.machines)}
 
     def placeVM(self, vm):
         tried = []
+        feasible = self._capacities.feasibleMask(vm)
         while len(self._machines) > 0:
             noVMs, machine = self._machines.popitem()
-            if machine.isFittable(vm):
+            if feasible[self._rows[machine]]:
                 scheduler = self._schedulers[machine]
                 scheduler.schedule(vm)
                 self._machines.add(noVMs+1, machine)
@@ -99,12 +119,16 @@ class JobSchedulerSimple(NotificationListener):
         self._autofree = autofree and isinstance(machine, VirtualMachine)
         self._finished = False
         self._suspended = False
+        self.subscribe(NType.JobFinish, host=machine)
+        self.subscribe(NType.JobStart, host=machine)
+        self.subscribe(NType.VMStart, vm=machine)
+        self.subscribe(NType.Other, message="SimulationStart")
 
     def _autoFreeHost(self):
         if not self._finished and self._autofree and \
            len(self._jobQueue) == 0 and \
-           len(self._machine.jobsUsing) == 0 and \
-           len(self._machine.vmsUsing) == 0:
+           self._machine.noJobsUsing == 0 and \
+           self._machine.noVMsUsing == 0:
             now = Simulator.getInstance().time
             event = VMEnd(self._machine.host, self._machine)
             Simulator.getInstance().addEvent(now, event)
@@ -1,3 +1,4 @@
+import numpy as np
 from toolkit import *
 from Simulator import *
 from Listeners import *
@@ -19,6 +20,64 @@ class BinPackingScheduler(VMSchedulerSimple):
        amount of resources that job
     """
 
+    class BinsAggregates:
+        """
+        Running aggregates of open bins kept in NumPy arrays:
+        used dims, number of tasks, length and usage integral
+        (task length times dim) per resource type.
+        Valid only for bins with `additive` class attribute set.
+        """
+        def __init__(self, maxDims):
+            self.rtypes = list(maxDims.keys())
+            self._cols = {rtype: i for i, rtype in enumerate(self.rtypes)}
+            self.maxDims = np.array([maxDims[r] for r in self.rtypes], dtype=float)
+            self.bins = []
+            self.used = np.zeros((16, len(self.rtypes)))
+            self.usage = np.zeros((16, len(self.rtypes)))
+            self.lengths = np.zeros(16)
+            self.noTasks = np.zeros(16, dtype=int)
+
+        def __len__(self):
+            return len(self.bins)
+
+        def column(self, rtype):
+            return self._cols[rtype]
+
+        def taskVector(self, task):
+            vec = np.zeros(len(self.rtypes))
+            for rtype, value in task.dims.items():
+                vec[self._cols[rtype]] = value
+            return vec
+
+        def append(self, bucket):
+            n = len(self.bins)
+            if n == len(self.lengths):
+                self.used = np.concatenate((self.used, np.zeros_like(self.used)))
+                self.usage = np.concatenate((self.usage, np.zeros_like(self.usage)))
+                self.lengths = np.concatenate((self.lengths, np.zeros(n)))
+                self.noTasks = np.concatenate((self.noTasks, np.zeros(n, dtype=int)))
+            self.bins += [bucket]
+            self.used[n] = 0
+            self.usage[n] = 0
+            self.lengths[n] = 0
+            self.noTasks[n] = 0
+
+        def add(self, bucket, task, vec, length):
+            i = self.bins.index(bucket)
+            self.used[i] += vec
+            self.usage[i] += length * vec
+            self.lengths[i] = max(self.lengths[i], length)
+            self.noTasks[i] += 1
+
+        def remove(self, bucket):
+            if bucket not in self.bins:
+                return
+            i = self.bins.index(bucket)
+            n = len(self.bins)
+            for arr in (self.used, self.usage, self.lengths, self.noTasks):
+                arr[i:n-1] = arr[i+1:n]
+            del self.bins[i]
+
 
     def __init__(self, machine, BinClass=SimpleBin,
                  awaitBins=True, binTasksLimit=None, lengthDiffTolerance=None):
@@ -49,6 +108,12 @@ class BinPackingScheduler(VMSchedulerSimple):
         self._listener = EventInspector() if awaitBins else None
         self._binTasksLimit = binTasksLimit
         self._lengthDiffTolerance = lengthDiffTolerance
+        self._aggregates = None
+        if getattr(BinClass, 'additive', False):
+            self._aggregates = self.BinsAggregates(self._maxDims)
+        # bins by priority/length, while all jobs have linear priorities
+        self._priorities = KineticHeap(NOW())
+        self._linear = {} # {bin: [priority slope, intercept, length]}
 
     @property
     def noVMsLeft(self):
@@ -73,10 +138,22 @@ class BinPackingScheduler(VMSchedulerSimple):
         #                         key=lambda b: b.efficiency()[RType.CPU_core])
         #  self._currentBin = max(self._bins,
         #                         key=lambda b: len(b.vms)/b.length)
-        self._currentBin = max(self._bins,
-                               key=lambda b: b.priority/b.length)
+        if self._priorities is not None and \
+           len(self._priorities) == len(self._bins):
+            self._currentBin = self._priorities.top(NOW())
+        else:
+            self._currentBin = max(self._bins,
+                                   key=lambda b: b.priority/b.length)
         idx = self._bins.index(self._currentBin)
         del self._bins[idx]
+        if self._priorities is not None and \
+           self._currentBin in self._priorities:
+            self._priorities.remove(self._currentBin)
+        self._linear.pop(self._currentBin, None)
+        if self._aggregates is not None:
+            self._aggregates.remove(self._currentBin)
+        for vm in self._currentBin.vms:
+            self._dequeued(vm)
         self._currentBin.close()
         return True
 
@@ -97,6 +174,33 @@ class BinPackingScheduler(VMSchedulerSimple):
             self._listener.addExpectation(what=NType.JobFinish, job=task.job)
         return task.vm
 
+    def _updatePriority(self, bucket, task=None):
+        """
+        Updates key of `bucket` in kinetic heap of priorities,
+        after `task` was added to it or its length changed.
+        """
+        if self._priorities is None:
+            return
+        if task is not None:
+            coefficients = task.job.linearPriority
+            if coefficients is None:
+                # arbitrary priority functions need full scans
+                self._priorities = None
+                return
+            if bucket not in self._linear:
+                self._linear[bucket] = [0, 0, None]
+            self._linear[bucket][0] += coefficients[0]
+            self._linear[bucket][1] += coefficients[1]
+        slope, intercept, length = self._linear[bucket]
+        if task is None and bucket.length == length:
+            return
+        length = self._linear[bucket][2] = bucket.length
+        self._priorities.advance(NOW())
+        if bucket in self._priorities:
+            self._priorities.update(bucket, slope/length, intercept/length)
+        else:
+            self._priorities.push(bucket, slope/length, intercept/length)
+
     def checkFitting(self, bucket, task):
         if self._lengthDiffTolerance:
             lgthDiff = abs(bucket.length - task.length) / bucket.length
@@ -116,26 +220,72 @@ class BinPackingScheduler(VMSchedulerSimple):
             return dictMultiply(1 - lgthDiff, dEff)
         return dEff
 
+    def findBestFitting(self, vec, length):
+        """
+        Vectorized equivalent of choosing the bin with the highest
+        `checkFitting(bucket, task)[RType.CPU_core]`.
+        Returns None if task fits into no bin.
+        """
+        agg = self._aggregates
+        n = len(agg)
+        if n == 0:
+            return None
+        fits = np.all(agg.used[:n] + vec <= agg.maxDims, axis=1)
+        if self._binTasksLimit:
+            fits &= agg.noTasks[:n] < self._binTasksLimit
+        lgh0 = agg.lengths[:n]
+        lgh1 = np.maximum(lgh0, length)
+        fits &= ~(lgh1 + 1e-5 > lgh0 + length)
+        cpu = agg.column(RType.CPU_core)
+        cpuMax = agg.maxDims[cpu]
+        usage0 = agg.usage[:n, cpu]
+        usage1 = usage0 + length * vec[cpu]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = usage0 / (cpuMax * lgh0) - usage1 / (cpuMax * lgh1)
+            if self._lengthDiffTolerance:
+                lgthDiff = np.abs(lgh0 - length) / lgh0
+                fits &= ~(lgthDiff > self._lengthDiffTolerance)
+                score = (1 - lgthDiff) * score
+        score = np.where(fits & ~np.isnan(score), score, -INF)
+        best = int(np.argmax(score))
+        if score[best] > -INF:
+            return agg.bins[best]
+        return None
+
     def schedule(self, vm):
         if not self._machine.isFittable(vm):
             raise Exception(f"{vm.name} can never be allocated"
                             f" on {self._machine.name}")
         task = Task(vm, host_freqs=self._host_freqs, gpus_nCC=self._gpu_min_nCC)
         bestBucket = None
-        bestScore = {}
-        for key in self._maxDims.keys():
-            bestScore[key] = -INF
-        for bucket in self._bins:
-            score = self.checkFitting(bucket, task)
-            if score is None:
-                continue
-            if score[RType.CPU_core] > bestScore[RType.CPU_core]:
-                bestBucket = bucket
-                bestScore = score
+        if self._aggregates is not None:
+            vec = self._aggregates.taskVector(task)
+            length = task.length
+            bestBucket = self.findBestFitting(vec, length)
+        else:
+            bestScore = {}
+            for key in self._maxDims.keys():
+                bestScore[key] = -INF
+            for bucket in self._bins:
+                score = self.checkFitting(bucket, task)
+                if bucket in self._linear:
+                    # trial addition might have changed the layout
+                    self._updatePriority(bucket)
+                if score is None:
+                    continue
+                if score[RType.CPU_core] > bestScore[RType.CPU_core]:
+                    bestBucket = bucket
+                    bestScore = score
         if bestBucket is None:
             self._bins += [self.BinClass(self._maxDims, self._binTasksLimit)]
             bestBucket = self._bins[-1]
+            if self._aggregates is not None:
+                self._aggregates.append(bestBucket)
         added = bestBucket.add(task)
         if not added:
             raise Exception(f"{vm.name} cannot be fit into any bucket")
+        if self._aggregates is not None:
+            self._aggregates.add(bestBucket, task, vec, length)
+        self._updatePriority(bestBucket, task)
+        self._enqueued(vm)
 
@@ -1,4 +1,7 @@
-from itertools import permutations
+import bisect
+import heapq
+import numpy as np
+from time import monotonic
 from toolkit import *
 from Simulator import *
 from Events import *
@@ -9,20 +12,67 @@ from scheduling.Task import *
 
 
 class SimpleBin:
+    # adding a task only adds its dims and usage to the bin
+    additive = True
+
     def __init__(self, maxDims, tasksLimit=None):
         self.maxDims = maxDims # {RType: maxSize}
         self._tasks = set()
         self._closed = False
         self._tasksLimit = tasksLimit
+        self._rebuild()
+        self._priority = None # (time, priority)
+
+    def _rebuild(self):
+        """
+        Recalculates running aggregates of all tasks in the bin.
+        """
+        self._dims = {rtype: 0 for rtype in self.maxDims.keys()}
+        self._usage = {rtype: 0 for rtype in self.maxDims.keys()}
+        self._lengths = {} # {task: length}
+        self._longest = [] # max-heap of (-length, seq, task), lazily cleaned
+        self._seq = 0
+        self._efficiency = None
+        self._undo = None # (task, dims, usage, efficiency) from before add
+        for task in self._tasks:
+            self._track(task)
+
+    def _track(self, task):
+        length = task.length
+        for rtype, value in task.dims.items():
+            self._dims[rtype] += value
+            self._usage[rtype] += length * value
+        self._lengths[task] = length
+        heapq.heappush(self._longest, (-length, self._seq, task))
+        self._seq += 1
+        if len(self._longest) > 2 * len(self._lengths) + 16:
+            self._longest = [(-l, i, t) for i, (t, l)
+                             in enumerate(self._lengths.items())]
+            heapq.heapify(self._longest)
+        self._efficiency = None
+        self._priority = None
+
+    def _untrack(self, task):
+        length = self._lengths.pop(task)
+        for rtype, value in task.dims.items():
+            self._dims[rtype] -= value
+            self._usage[rtype] -= length * value
+        self._efficiency = None
+        self._priority = None
 
     @property
     def length(self):
-        longest = max(self._tasks, key=lambda t: t.length)
-        return longest.length
+        while self._lengths.get(self._longest[0][2]) != -self._longest[0][0]:
+            heapq.heappop(self._longest)
+        return -self._longest[0][0]
 
     @property
     def priority(self):
-        return sum([task.job.priority for task in self._tasks])
+        now = NOW()
+        if self._priority is None or self._priority[0] != now:
+            priority = sum([task.job.priority for task in self._tasks])
+            self._priority = (now, priority)
+        return self._priority[1]
 
     @property
     def vms(self):
@@ -30,13 +80,7 @@ class SimpleBin:
 
     @property
     def currentDims(self):
-        dims = {}
-        for rtype in self.maxDims.keys():
-            dims[rtype] = 0
-        for task in self._tasks:
-            for rtype, value in task.dims.items():
-                dims[rtype] += value
-        return dims
+        return dict(self._dims)
 
     def add(self, task):
         if self._closed:
@@ -45,19 +89,36 @@ class SimpleBin:
             return False
         for rtype, value in task.dims.items():
             assert rtype in self.maxDims
-            if value + self.currentDims[rtype] > self.maxDims[rtype]:
+            if value + self._dims[rtype] > self.maxDims[rtype]:
                 return False
+        undo = (task, dict(self._dims), dict(self._usage), self._efficiency)
         self._tasks.add(task)
+        self._track(task)
+        self._undo = undo
         return True
 
     def remove(self, task):
         if self._closed:
             raise Exception("Bin already closed")
         self._tasks.remove(task)
+        self._untrack(task)
+        undo, self._undo = self._undo, None
+        if undo is not None and undo[0] is task:
+            # exact state from before the last add
+            _, self._dims, self._usage, self._efficiency = undo
 
     def efficiency(self, tasks=None):
-        if tasks is None:
-            tasks = self._tasks
+        if tasks is not None:
+            return self._calculateEfficiency(tasks)
+        if self._efficiency is None:
+            length = self.length
+            self._efficiency = {}
+            for rtype in self.maxDims.keys():
+                self._efficiency[rtype] = self._usage[rtype] / \
+                    (self.maxDims[rtype] * length)
+        return dict(self._efficiency)
+
+    def _calculateEfficiency(self, tasks):
         rtypes = self.maxDims.keys()
         length = self.length
         eff = {}
@@ -89,33 +150,50 @@ class SimpleBin:
 
 
 class ReductiveBin(SimpleBin):
+    additive = False
+
+    def _rebuild(self):
+        # heap of (length after reduction, seq, task, noCores), lazily cleaned
+        self._reducible = []
+        super()._rebuild()
+
+    def _track(self, task):
+        super()._track(task)
+        noCores = task.dims[RType.CPU_core]
+        if noCores >= 2:
+            futureLength = (self._lengths[task] * noCores) / (noCores - 1)
+            heapq.heappush(self._reducible,
+                           (futureLength, self._seq, task, noCores))
+            self._seq += 1
 
     def _reduceOne(self):
-        bestToReduce = None
-        lengthOverhead = INF
-        for task in self._tasks:
-            noCores = task.dims[RType.CPU_core]
-            if noCores < 2:
-                continue
-            futureLength = (task.length * noCores) / (noCores - 1)
-            if futureLength - self.length < lengthOverhead:
-                lengthOverhead = futureLength - self.length
-                bestToReduce = task
-        if bestToReduce is not None:
-            bestToReduce.reduceCores()
-        return bestToReduce
+        while len(self._reducible) > 0:
+            _, _, task, noCores = self._reducible[0]
+            if task in self._lengths and \
+               task.dims[RType.CPU_core] == noCores:
+                break
+            heapq.heappop(self._reducible)
+        else:
+            return None
+        self._untrack(task)
+        task.reduceCores()
+        self._track(task)
+        return task
 
     def _restoreReduced(self, reduced=None):
         if reduced == None:
             for task in self._tasks:
                 task.restoreCores()
+            self._rebuild()
         else:
             for task, n in reduced.items():
+                self._untrack(task)
                 task.restoreCores(n)
+                self._track(task)
 
     def _refitJobs(self):
         reduced = {}
-        while self.currentDims[RType.CPU_core] > self.maxDims[RType.CPU_core]:
+        while self._dims[RType.CPU_core] > self.maxDims[RType.CPU_core]:
             redTask = self._reduceOne()
             if redTask is None:
                 self._restoreReduced(reduced)
@@ -134,12 +212,15 @@ class ReductiveBin(SimpleBin):
             if rtype == RType.CPU_core:
                 continue
             assert rtype in self.maxDims
-            if value + self.currentDims[rtype] > self.maxDims[rtype]:
+            if value + self._dims[rtype] > self.maxDims[rtype]:
                 return False
         self._tasks.add(task)
+        self._track(task)
+        self._undo = None
         if self._refitJobs():
             return True
         self._tasks.remove(task)
+        self._untrack(task)
         return False
 
     def remove(self, task):
@@ -150,6 +231,8 @@ class ReductiveBin(SimpleBin):
 
 
 class TimelineBin(SimpleBin):
+    additive = False
+
     def __init__(self, maxDims, tasksLimit=None):
         super().__init__(maxDims)
         self._tasks = Timeline()
@@ -160,6 +243,10 @@ class TimelineBin(SimpleBin):
         tp = self._tasks.timepoints()
         return tp[-1] - tp[0]
 
+    @property
+    def priority(self):
+        return sum([task.job.priority for task in self._tasks])
+
     @property
     def vms(self):
         return [task.vm for task in self._tasks.allTasks]
@@ -168,29 +255,43 @@ class TimelineBin(SimpleBin):
     def currentDims(self):
         raise NotImplementedError("TimelineBin has no 'currentDims'")
 
+    def efficiency(self, tasks=None):
+        if tasks is None:
+            tasks = self._tasks
+        return self._calculateEfficiency(tasks)
+
     @staticmethod
     def addToTimeline(tasks, maxDims, task):
-        timepoints = tasks.timepoints()
-        if len(timepoints) == 0:
+        """
+        Adds `task` at the first timepoint, from which it fits for
+        the whole window up to (and including) the first timepoint
+        at least `task.length` later. Windows of all timepoints are
+        checked at once with a prefix count of violations, in
+        O(n log n) vectorized work for n timepoints.
+        """
+        if len(tasks.timepoints()) == 0:
             tasks.add(0, task)
             return True
-        lastOK = None
-        for time in timepoints:
-            tasksAt = tasks[time]
-            occupied = Task.sum(tasksAt)
-            allOK = True
-            for rtype, limit in maxDims.items():
-                allOK *= occupied.get(rtype, 0) + task.dims.get(rtype, 0) \
-                      <= maxDims[rtype]
-            if allOK:
-                if lastOK is None:
-                    lastOK = time
-                elif time - lastOK >= task.length:
-                    break
-            else:
-                lastOK = None
-        assert lastOK is not None
-        tasks.add(lastOK, task)
+        points, ok = tasks.fittingMask(task.dims, maxDims)
+        length = task.length
+        n = len(points)
+        starts = np.arange(n)
+        # first timepoint `end` of each window with `end - start >= length`,
+        # corrected for rounding of `start + length`
+        ends = np.minimum(np.searchsorted(points, points + length), n)
+        while True:
+            late = (ends > 0) & \
+                (points[np.maximum(ends - 1, 0)] - points >= length)
+            short = ends < n
+            short[short] = points[ends[short]] - points[short] < length
+            if not late.any() and not short.any():
+                break
+            ends = ends - late + short
+        last = np.minimum(np.maximum(ends, starts + 1), n - 1)
+        noViolations = np.concatenate(([0], np.cumsum(~ok)))
+        fits = noViolations[last + 1] == noViolations[starts]
+        assert fits.any()
+        tasks.add(tasks.timepoints()[int(np.argmax(fits))], task)
         return True
 
     def add(self, task):
@@ -204,6 +305,11 @@ class TimelineBin(SimpleBin):
                 return False
         return self.addToTimeline(self._tasks, self.maxDims, task)
 
+    def remove(self, task):
+        if self._closed:
+            raise Exception("Bin already closed")
+        self._tasks.remove(task)
+
     def close(self):
         self._tasks = list(self._tasks)
         self._closed = True
@@ -211,9 +317,19 @@ class TimelineBin(SimpleBin):
 
 
 class OrderedTimelineBin(TimelineBin):
+    # keep tasks longest first by replacing only tasks after changed
+    # position, instead of `_orderAdd` and `_orderRemove`
+    incrementalLongestFirst = False
+
     def __init__(self, maxDims, tasksLimit=None):
         super().__init__(maxDims, tasksLimit)
-        self._prevTl = None
+        # (task, timeline, journal) to revert the last add
+        self._undo = None
+        self._order = [] # tasks in longest first order
+        self._keys = [] # their negated lengths
+        self._journals = [] # journals of their insertions
+        # (task, [(task, startpoint)]) of tasks replaced by the last add
+        self._replaced = None
 
     @staticmethod
     def _orderAdd(timeline, maxDims):
@@ -236,24 +352,64 @@ class OrderedTimelineBin(TimelineBin):
             assert rtype in self.maxDims
             if value > self.maxDims[rtype]:
                 return False
-        prevTl = self._prevTl
-        self._prevTl = self._tasks.copy()
-        assert self.addToTimeline(self._tasks, self.maxDims, task)
-        self._tasks = self._orderAdd(self._tasks, self.maxDims)
+        if self.incrementalLongestFirst:
+            # placed after tasks of the same length, as with stable sort
+            idx = bisect.bisect_right(self._keys, -task.length)
+            suffix = [(t, t.startpoint) for t in self._order[idx:]]
+            self._unplaceFrom(idx)
+            self._place([task] + [t for t, _ in suffix])
+            self._replaced = (task, suffix)
+            return True
+        timeline = self._tasks
+        timeline.startJournal()
+        assert self.addToTimeline(timeline, self.maxDims, task)
+        journal = timeline.stopJournal()
+        # `_orderAdd` returns either the same timeline or a new one
+        self._tasks = self._orderAdd(timeline, self.maxDims)
+        self._undo = (task, timeline, journal)
         return True
 
     def remove(self, task):
         if self._closed:
             raise Exception("Bin already closed")
-        if self._prevTl is not None:
-            diff = self._tasks.allTasks.difference(self._prevTl.allTasks)
-            if len(diff) == 1 and task in diff:
-                self._tasks = self._prevTl
-                self._prevTl = None
-                return
+        if self.incrementalLongestFirst:
+            idx = self._order.index(task)
+            suffix = self._order[idx+1:]
+            self._unplaceFrom(idx)
+            if self._replaced is not None and self._replaced[0] is task:
+                # previous layout of the tasks is known
+                self._place(*zip(*self._replaced[1]))
+            else:
+                self._place(suffix)
+            self._replaced = None
+            return
+        if self._undo is not None and self._undo[0] is task:
+            _, timeline, journal = self._undo
+            timeline.undo(journal)
+            self._tasks = timeline
+            self._undo = None
+            return
         self._tasks.remove(task)
         self._tasks = self._orderRemove(self._tasks, self.maxDims)
-        self._prevTl = None
+        self._undo = None
+
+    def _unplaceFrom(self, idx):
+        for journal in reversed(self._journals[idx:]):
+            self._tasks.undo(journal)
+        del self._order[idx:]
+        del self._keys[idx:]
+        del self._journals[idx:]
+
+    def _place(self, tasks=(), startpoints=None):
+        for i, task in enumerate(tasks):
+            self._tasks.startJournal()
+            if startpoints is None:
+                assert self.addToTimeline(self._tasks, self.maxDims, task)
+            else:
+                self._tasks.add(startpoints[i], task)
+            self._journals += [self._tasks.stopJournal()]
+            self._order += [task]
+            self._keys += [-task.length]
 
     def close(self):
         tasks = self._orderClose(self._tasks, self.maxDims)
@@ -271,23 +427,120 @@ def orderLongestFirst(timeline, maxDims):
     return new_tl
 
 
-def orderExhausive(timeline, maxDims):
+def _makespan(timeline):
+    timepoints = timeline.timepoints()
+    return timepoints[-1] - timepoints[0]
+
+
+def orderExhausive(timeline, maxDims, nodeLimit=None, timeLimit=None):
+    """
+    Returns timeline built in the order of tasks giving the shortest
+    makespan (the first such in order of `permutations`).
+    Orders are searched with branch-and-bound: prefixes are pruned with
+    lower bounds (current makespan, longest remaining task, usage of
+    remaining tasks exceeding free capacity they could fit in) and when
+    they lead to an already seen layout. Search stops once an order
+    reaches the total usage per capacity.
+    When `nodeLimit` tried insertions or `timeLimit` seconds are
+    exhausted, the best order found so far is used, or longest-first
+    order if it is better.
+    """
     tasks = list(timeline.allTasks)
-    best_tl = None
-    best_score = INF
-    for tasksPerm in permutations(tasks):
-        new_tl = Timeline()
-        for task in tasksPerm:
-            assert TimelineBin.addToTimeline(new_tl, maxDims, task)
-        score = new_tl.timepoints()[-1] - new_tl.timepoints()[0]
-        if score < best_score:
-            best_score = score
-            best_tl = new_tl
-    return best_tl
+    n = len(tasks)
+    if n == 0:
+        return Timeline()
+    lengths = [task.length for task in tasks]
+    shapes = [(lengths[i], tuple(sorted((rtype.value, value)
+                                        for rtype, value in task.dims.items())))
+              for i, task in enumerate(tasks)]
+    demands = {rtype: [task.dims.get(rtype, 0) for task in tasks]
+               for rtype in maxDims.keys()}
+    areas = {rtype: [l * d for l, d in zip(lengths, demands[rtype])]
+             for rtype in maxDims.keys()}
+    bound = max(lengths)
+    for rtype, limit in maxDims.items():
+        bound = max(bound, sum(areas[rtype]) / limit)
+    # orders within rounding of the usage sum are optimal
+    bound *= 1 + 1e-9
+    lfScore = _makespan(orderLongestFirst(timeline, maxDims))
+    deadline = None if timeLimit is None else monotonic() + timeLimit
+
+    best = [None, INF] # [order, makespan]
+    tl = Timeline()
+    order = []
+    used = [False] * n
+    remaining = {rtype: sum(area) for rtype, area in areas.items()}
+    seen = set()
+    nodes = 0
+
+    def exhausted():
+        if nodeLimit is not None and nodes >= nodeLimit:
+            return True
+        return deadline is not None and monotonic() > deadline
+
+    def areaBound(makespan):
+        # remaining tasks use free capacity of the prefix only where
+        # at least their smallest demand is free, the rest goes after it
+        result = makespan
+        for rtype, limit in maxDims.items():
+            smallest = min([demands[rtype][j] for j in range(n)
+                            if not used[j] and demands[rtype][j] > 0],
+                           default=None)
+            if smallest is None:
+                continue
+            usable = tl.usableArea(rtype, limit, smallest)
+            result = max(result, makespan +
+                         (remaining[rtype] - usable) / limit * (1 - 1e-9))
+        return result
+
+    def search():
+        nonlocal nodes
+        if len(order) == n:
+            score = _makespan(tl)
+            if score < best[1]:
+                best[0], best[1] = list(order), score
+            return
+        for i in range(n):
+            if used[i]:
+                continue
+            if exhausted() or best[1] <= bound:
+                return
+            nodes += 1
+            tl.startJournal()
+            assert TimelineBin.addToTimeline(tl, maxDims, tasks[i])
+            journal = tl.stopJournal()
+            used[i] = True
+            order.append(i)
+            for rtype in maxDims.keys():
+                remaining[rtype] -= areas[rtype][i]
+            lowerBound = max([areaBound(_makespan(tl))] +
+                             [lengths[j] for j in range(n) if not used[j]])
+            if lowerBound <= lfScore and lowerBound < best[1]:
+                layout = tuple(sorted((tasks[j].startpoint, shapes[j])
+                                      for j in order))
+                if layout not in seen:
+                    seen.add(layout)
+                    search()
+            order.pop()
+            used[i] = False
+            for rtype in maxDims.keys():
+                remaining[rtype] += areas[rtype][i]
+            tl.undo(journal)
+
+    search()
+    if best[0] is None or best[1] > lfScore:
+        return orderLongestFirst(timeline, maxDims)
+    new_tl = Timeline()
+    for i in best[0]:
+        assert TimelineBin.addToTimeline(new_tl, maxDims, tasks[i])
+    return new_tl
 
 
 def OrderedTimelineBinClass(orderAdd, orderRemove, orderClose):
     class _OrderedTimelineBin(OrderedTimelineBin):
+        incrementalLongestFirst = orderAdd is orderLongestFirst and \
+                                  orderRemove is orderLongestFirst
+
         @staticmethod
         def _orderAdd(timeline, maxDims):
             return orderAdd(timeline, maxDims)
@@ -0,0 +1,95 @@
+import numpy as np
+from Simulator import *
+
+
+class VectorizedEnvironment:
+    """
+    Runs independent simulations in lock-step. Each of them is
+    simulated up to its next placement decision, decisions of all
+    of them are scored in one model call, and chosen machines are
+    dispatched back to the simulations.
+    Simulations are given as (Simulator, policy) pairs, where policy
+    is `VMPlacementPolicyAI` (or `PolicyGradient`) of infrastructure
+    created in that simulator, with `batch='external'`. All policies
+    should share one model, decisions are scored by the first one.
+    """
+
+    def __init__(self, simulations):
+        self._simulations = list(simulations)
+        for _, policy in self._simulations:
+            assert policy._batch == 'external'
+        self._finished = len(self._simulations)*[False]
+
+    def __len__(self):
+        return len(self._simulations)
+
+    @property
+    def policies(self):
+        return [policy for _, policy in self._simulations]
+
+    def advance(self):
+        """
+        Simulates each simulation up to its next placement decision.
+        Returns indices of simulations awaiting decisions, empty
+        list when all simulations have finished.
+        """
+        awaiting = []
+        for i, (sim, policy) in enumerate(self._simulations):
+            if policy._awaiting is None and not self._finished[i]:
+                self._finished[i] = sim.simulate(
+                    until=lambda: policy._awaiting is not None)
+            if policy._awaiting is not None:
+                awaiting += [i]
+        return awaiting
+
+    def observe(self, awaiting):
+        """
+        Returns batch of (state info, task info) of all decisions
+        awaited by simulations with indices `awaiting`.
+        """
+        states, tasks = [], []
+        for i in awaiting:
+            sim, policy = self._simulations[i]
+            with sim:
+                state_info, task_info = policy._observe(policy._awaiting)
+            states += [state_info]
+            tasks += [task_info]
+        return np.concatenate(states), np.concatenate(tasks)
+
+    def act(self, awaiting, state_info, task_info, scores):
+        """
+        Dispatches rows of `scores` (computed for `observe(awaiting)`)
+        back to the simulations.
+        """
+        begin = 0
+        for i in awaiting:
+            sim, policy = self._simulations[i]
+            end = begin + len(policy._awaiting)
+            with sim:
+                policy.placeAwaiting(state_info[begin:end],
+                                     task_info[begin:end], scores[begin:end])
+            begin = end
+
+    def loss(self):
+        """
+        Returns summed losses of finished runs of `PolicyGradient`
+        policies, for `step` of the first one.
+        """
+        total = 0
+        for sim, policy in self._simulations:
+            with sim:
+                total = total + policy.loss()
+        return total
+
+    def run(self):
+        """
+        Runs all simulations to the end.
+        """
+        policy = self._simulations[0][1]
+        while True:
+            awaiting = self.advance()
+            if len(awaiting) == 0:
+                return
+            state_info, task_info = self.observe(awaiting)
+            scores = policy._evaluate(state_info, task_info)
+            self.act(awaiting, state_info, task_info, scores)
@@ -121,14 +121,28 @@ class Model_v0_torch(torch.nn.Module):
         cat = torch.Tensor(cat).expand(-1,task_dim,x.shape[-1])
         return x, cat
 
-    def forward(self, inp):
+    def normalize(self, bn, x, separate=False):
+        """
+        Applies batch norm `bn`. With `separate` set, in training mode
+        each sample is normalized with its own statistics, as if passed
+        alone, and running statistics are not updated.
+        """
+        if not separate or not self.training:
+            return bn(x)
+        n, c, l = x.shape
+        x = torch.nn.functional.batch_norm(x.reshape(1, n*c, l), None, None,
+                                           bn.weight.repeat(n), bn.bias.repeat(n),
+                                           True, 0., bn.eps)
+        return x.reshape(n, c, l)
+
+    def forward(self, inp, separate=False):
         x, cat = self.prepare(inp)
         x = torch.cat((x, cat), 1)
-        x = self.bn0(x)
+        x = self.normalize(self.bn0, x, separate)
         x = self.conv0(x)
         x = self.activ0(x)
         x = torch.cat((x, cat), 1)
-        x = self.bn1(x)
+        x = self.normalize(self.bn1, x, separate)
         x = self.conv1(x)
         x = self.flat(x)
         x = self.sm(x)
@@ -1,4 +1,5 @@
 #  from multiset import Multiset
+import numpy as np
 from toolkit import *
 from Simulator import *
 from Events import *
@@ -13,7 +14,12 @@ class Task:
     1. All GPUs of the host machine are the same.
     2. All CPU cores of the host machine are the same.
     3. Tasks fully utilizes resource they requested.
+    Length is calculated once and recalculated only when
+    number of cores changes.
     '''
+    __slots__ = ('vm', 'job', 'dims', 'gpus_nCC', 'host_freqs',
+                 'startpoint', '_maxCores', '_length')
+
     def __init__(self, vm, host_freqs={RType.CPU_core: 1}, gpus_nCC=None):
         self.vm = vm
         assert vm._jobScheduler is not None
@@ -39,6 +45,9 @@ class Task:
             self.gpus_nCC = gpus_nCC
         self.host_freqs = host_freqs
         self.startpoint = None
+        self._maxCores = len(list(filter(lambda r: r.rtype == RType.CPU_core,
+                                         self.job.resourceRequest)))
+        self._length = self._calculateLength()
 
     def reduceCores(self, n=-1):
         noCores = self.dims[RType.CPU_core]
@@ -48,17 +57,21 @@ class Task:
             raise Exception("Task has to have at leat 1 core assigned")
         if n < noCores:
             self.dims[RType.CPU_core] = n
+            self._length = self._calculateLength()
         return noCores
 
     def restoreCores(self, n=INF):
-        maxCores = len(list(filter(lambda r: r.rtype == RType.CPU_core,
-                                  self.job.resourceRequest)))
         currentCores = self.dims[RType.CPU_core]
-        self.dims[RType.CPU_core] = min(maxCores, currentCores + n)
+        self.dims[RType.CPU_core] = min(self._maxCores, currentCores + n)
+        if self.dims[RType.CPU_core] != currentCores:
+            self._length = self._calculateLength()
         return self.dims[RType.CPU_core]
 
     @property
     def length(self):
+        return self._length
+
+    def _calculateLength(self):
         opss = []
         for rtype, ops in self.job.operations.items():
             noCores = self.dims[rtype] * self.host_freqs[rtype]
@@ -85,9 +98,22 @@ class Task:
 
 
 class Timeline:
+    """
+    Tasks placed in time. Besides sets of tasks running at each
+    timepoint, it keeps occupancy of every resource type at the
+    timepoints in NumPy arrays, for vectorized placement queries.
+    This is not a segment tree: with n timepoints and R resource
+    types, adding or removing a timepoint copies the arrays, O(n*R),
+    adding a task updates its range in place, `remove` re-sums the
+    tasks running at each timepoint of its range, and `fittingMask`
+    scans all timepoints, O(n*R), though in NumPy instead of Python.
+    """
     def __init__(self):
         self._dict = Map()
         self.allTasks = Multiset()
+        self._points = np.zeros(0)
+        self._occupancy = {} # {rtype: np.array aligned with self._points}
+        self._journal = None
 
     def _completePoint(self, time):
         assert time in self.timepoints()
@@ -97,6 +123,12 @@ class Timeline:
             for task in tasks:
                 if task.endpoint > time:
                     self._dict[time].add(task)
+        idx = self._dict.index(time)
+        self._points = np.insert(self._points, idx, time)
+        occupied = Task.sum(self._dict[time])
+        for rtype in self._occupancy.keys():
+            self._occupancy[rtype] = np.insert(self._occupancy[rtype], idx,
+                                               occupied.get(rtype, 0))
 
     def _clearPoint(self, time):
         assert time in self.timepoints()
@@ -106,19 +138,37 @@ class Timeline:
             time_ = self._dict.first_key_lower(time)
             prevPoint = self._dict[time_]
         if prevPoint == thisPoint:# and \
+            idx = self._dict.index(time)
             del self._dict[time]
+            self._points = np.delete(self._points, idx)
+            for rtype in self._occupancy.keys():
+                self._occupancy[rtype] = np.delete(self._occupancy[rtype], idx)
 
     def add(self, time, task):
         if len(self.timepoints()) > 0:
             assert len(self._dict[self.timepoints()[-1]]) == 0
-        if time not in self._dict.keys():
-            self._dict[time] = set()
-            self._completePoint(time)
-        if time + task.length not in self._dict.keys():
-            self._dict[time + task.length] = set()
-            self._completePoint(time + task.length)
+        journal = self._journal
+        for rtype in task.dims.keys():
+            if rtype not in self._occupancy.keys():
+                self._occupancy[rtype] = np.zeros(len(self._points))
+                if journal is not None:
+                    journal += [('rtype', rtype)]
+        for point in (time, time + task.length):
+            if point not in self._dict.keys():
+                self._dict[point] = set()
+                self._completePoint(point)
+                if journal is not None:
+                    journal += [('point', point)]
+        begin = self._dict.index(time)
+        end = self._dict.index(time + task.length)
+        if journal is not None:
+            journal += [('task', task, task.startpoint, time, begin,
+                         {r: self._occupancy[r][begin:end].copy()
+                          for r in task.dims.keys()})]
         for t in self._dict.irange(time, time + task.length, (True, False)):
             self._dict[t].add(task)
+        for rtype, value in task.dims.items():
+            self._occupancy[rtype][begin:end] += value
         self.allTasks.add(task)
         task.startpoint = time
         if len(self.timepoints()) > 0:
@@ -130,12 +180,56 @@ class Timeline:
         self.allTasks.remove(task, 1)
         for t in self._dict.irange(task.startpoint, task.endpoint, (True, False)):
             self._dict[t].remove(task)
+        # recalculated instead of subtracted, so that rounding
+        # errors do not accumulate over trial insertions
+        begin = self._dict.index(task.startpoint)
+        end = self._dict.index(task.endpoint)
+        for idx in range(begin, end):
+            occupied = Task.sum(self._dict.peekitem(idx)[1])
+            for rtype in self._occupancy.keys():
+                self._occupancy[rtype][idx] = occupied.get(rtype, 0)
         self._clearPoint(task.startpoint)
         self._clearPoint(task.endpoint)
         task.startpoint = None
         if len(self.timepoints()) > 0:
             assert len(self._dict[self.timepoints()[-1]]) == 0
 
+    def startJournal(self):
+        """
+        Starts recording additions of tasks, so that they could be
+        reverted with `undo` at cost proportional to the changes.
+        """
+        self._journal = []
+
+    def stopJournal(self):
+        journal = self._journal
+        self._journal = None
+        return journal
+
+    def undo(self, journal):
+        """
+        Reverts additions recorded in `journal`
+        (no other changes are allowed in between).
+        """
+        for entry in reversed(journal):
+            if entry[0] == 'task':
+                _, task, startpoint, time, begin, occupied = entry
+                for t in self._dict.irange(time, time + task.length,
+                                           (True, False)):
+                    self._dict[t].remove(task)
+                for rtype, values in occupied.items():
+                    self._occupancy[rtype][begin:begin+len(values)] = values
+                self.allTasks.remove(task, 1)
+                task.startpoint = startpoint
+            elif entry[0] == 'point':
+                idx = self._dict.index(entry[1])
+                del self._dict[entry[1]]
+                self._points = np.delete(self._points, idx)
+                for rtype in self._occupancy.keys():
+                    self._occupancy[rtype] = np.delete(self._occupancy[rtype], idx)
+            elif entry[0] == 'rtype':
+                del self._occupancy[entry[1]]
+
     def __getitem__(self, time):
         assert time >= 0
         if time in self._dict.keys():
@@ -146,6 +240,33 @@ class Timeline:
     def timepoints(self):
         return self._dict.keys()
 
+    def fittingMask(self, dims, maxDims):
+        """
+        Returns np.array of timepoints and boolean np.array marking
+        timepoints, at which task of `dims` fits next to running tasks.
+        """
+        ok = np.ones(len(self._points), dtype=bool)
+        for rtype, limit in maxDims.items():
+            occupied = self._occupancy.get(rtype)
+            if occupied is None:
+                ok &= dims.get(rtype, 0) <= limit
+            else:
+                ok &= occupied + dims.get(rtype, 0) <= limit
+        return self._points, ok
+
+    def usableArea(self, rtype, limit, demand):
+        """
+        Returns free area of `rtype` (of capacity `limit`) within span
+        of the timeline, counting only intervals, in which at least
+        `demand` of it is free.
+        """
+        occupied = self._occupancy.get(rtype)
+        if occupied is None:
+            occupied = np.zeros(len(self._points))
+        free = limit - occupied[:-1]
+        area = free * np.diff(self._points)
+        return float(np.sum(area[free + 1e-9 >= demand]))
+
     def __iter__(self):
         tasksSet = set()
         tasksList = []
@@ -163,5 +284,7 @@ class Timeline:
         for time, tasks in self._dict.items():
             tl._dict[time] = tasks.copy()
         tl.allTasks = self.allTasks.copy()
+        tl._points = self._points.copy()
+        for rtype, occupied in self._occupancy.items():
+            tl._occupancy[rtype] = occupied.copy()
         return tl
-
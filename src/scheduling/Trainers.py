@@ -1,13 +1,70 @@
+import itertools
 import numpy as np
 import torch
 from joblib import Parallel, delayed
+import cloudpickle
+from Simulator import Simulator, Event
+from Machine import Machine
+from Job import Job
 from scheduling.VMPlacementPolicies import VMPlacementPolicyAI
 from Listeners import AUPMetric
 
 
+def _scoreInContext(payload, varList, seed):
+    """
+    Scores model with given variables in a fresh Simulator,
+    so listeners unpickled with `payload` are registered there.
+    Random generators are seeded with `seed`.
+    """
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    with Simulator():
+        model, score_fun = cloudpickle.loads(payload)
+        model.setVars(varList)
+        return score_fun(model)
+
+
+
+def _rolloutInContext(payload, state, seed):
+    """
+    Runs episode built by `make_episode` unpickled from `payload` in
+    a fresh Simulator, with model weights `state` and random generators
+    seeded with `seed`. Returns gradients of the episode's loss,
+    value of the loss and model's buffers updated during the episode.
+    """
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    # worker processes are reused, and creation indices (hashes of
+    # machines, so the order of them in policy) must not depend on
+    # episodes run there before
+    Event._indices = itertools.count()
+    Job._indices = itertools.count()
+    Machine._indices = itertools.count()
+    with Simulator() as sim:
+        make_episode = cloudpickle.loads(payload)
+        policy = make_episode()._vmPlacementPolicy
+        policy._model.load_state_dict(state)
+        sim.simulate()
+        loss = policy.loss()
+    policy._model.zero_grad()
+    loss.backward()
+    # parameters not reached by the loss are left without gradient
+    grads = [torch.zeros_like(p) if p.grad is None else p.grad
+             for p in policy._model.parameters()]
+    buffers = dict(policy._model.named_buffers())
+    return grads, loss.item(), buffers
+
+
+
 class RandomTrainer:
     def __init__(self, model, score_fun, epoch_size=100, n_bests=20,
-                 init_min=-1, init_max=1, n_threads=6):
+                 init_min=-1, init_max=1, n_threads=1):
+        """
+        With `n_threads` > 1 thetas are scored by worker processes,
+        on copies of `model` and `score_fun` (with everything it refers
+        to, e.g. infrastructure), with random generators seeded from
+        the caller's one.
+        """
         self.model = model
         self.score_fun = score_fun
         self._epoch_size = epoch_size
@@ -31,16 +88,21 @@ class RandomTrainer:
         return varList
 
     def scoreThetas(self):
-        def score_theta(i):
-            varList = self.toVars(self._thetas[i])
-            self.model.setVars(varList)
-            return self.score_fun(self.model)
-        # IMPOSSIBLE due to Simulator is a singleton
-        # TODO: make Simulator thread local
-        #  scores = Parallel(n_jobs=self._n_threads)(
-        #          delayed(score_theta)(i) for i in range(self._epoch_size)
-        #  )
-        scores = [score_theta(i) for i in range(self._epoch_size)]
+        if self._n_threads is None or self._n_threads <= 1:
+            def score_theta(i):
+                varList = self.toVars(self._thetas[i])
+                self.model.setVars(varList)
+                return self.score_fun(self.model)
+            scores = [score_theta(i) for i in range(self._epoch_size)]
+        else:
+            # each worker process gets its own copy of model and
+            # simulated infrastructure, run in its own Simulator
+            payload = cloudpickle.dumps((self.model, self.score_fun))
+            seeds = np.random.randint(2**31, size=self._epoch_size)
+            scores = Parallel(n_jobs=self._n_threads)(
+                    delayed(_scoreInContext)(payload, self.toVars(theta), seed)
+                    for theta, seed in zip(self._thetas, seeds)
+            )
         self._scores = np.array(scores)
 
     def getBests(self, n_bests):
@@ -71,62 +133,119 @@ class PolicyGradient(VMPlacementPolicyAI):
 
     class Reward_F(AUPMetric):
         def __call__(self, jobs):
-            rewards = []
-            for job in jobs:
-                sched, start, f = self._jobs[job]
-                cost = self._calculateCost(sched, start, f)
-                #  print(job.name, -cost)
-                rewards += [-cost]
-            return rewards
-
-    def __init__(self, *args, lr=0.01, gamma=0.95, **kwargs):
+            if len(jobs) == 0:
+                return []
+            scheds, starts, fs = zip(*[self._jobs[job] for job in jobs])
+            costs = self._calculateCosts(scheds, starts, fs)
+            return (-costs).tolist()
+
+    def __init__(self, *args, lr=0.01, gamma=0.95, light_history=False, **kwargs):
+        """
+        With `light_history` only inputs of the model and chosen actions
+        are kept (in preallocated arrays) instead of autograd graphs of
+        all decisions, and `step` recomputes log-probabilities of all of
+        them in one forward pass. Model has to accept `separate` argument
+        (see `Model_v0_torch.normalize`).
+        """
         super().__init__(*args, **kwargs)
         self._optim = torch.optim.Adam(self._model.parameters(),
                                        lr=lr)
         self._gamma = gamma
         self._reward_f = None
         self._history = [] #[(vm, log(P(action)) )]
+        self._light_history = light_history
+        self._buffers = None # [states, tasks, masks, actions]
+        # rows of `self._machines` in feasibility masks
+        self._maskIndex = np.array([self._rows[m] for m in self._machines])
+
+    def _evaluate(self, state_info, task_info):
+        """
+        Returns probabilities of actions as torch tensor. Batch of many
+        decisions is evaluated as if each was evaluated alone.
+        """
+        separate = len(task_info) > 1
+        if self._light_history:
+            with torch.no_grad():
+                return self._model((state_info, task_info), separate=separate)
+        if separate:
+            return self._model((state_info, task_info), separate=True)
+        return self._model((state_info, task_info))
+
+    def _placeScored(self, vms, state_info, task_info, torch_probs):
+        for i, vm in enumerate(vms):
+            self._sample(vm, state_info[i:i+1], task_info[i:i+1],
+                         torch_probs[i:i+1])
+
+    def _sample(self, vm, state_info, task_info, torch_probs):
+        """
+        Places `vm` on machine sampled from `torch_probs`
+        and remembers the decision.
+        """
+        # masked softmax: probabilities renormalized over
+        # machines that can ever host the vm, sampled once
+        feasible = self._capacities.feasibleMask(vm)[self._maskIndex]
+        if not feasible.any():
+            raise Exception(f"Non of the known machines"
+                            f" is suitable for {vm.name}")
+        np_probs = torch_probs.detach().numpy()[0].astype(float) + 1e-8
+        np_probs *= feasible
+        np_probs /= np_probs.sum()
+        action = np.random.choice(np_probs.shape[-1], p=np_probs)
+        machine = self._machines[action]
+        job = vm._jobScheduler._jobQueue[0]
+        if self._light_history:
+            n = self._record(state_info, task_info, feasible, action)
+            self._history += [(job, n)]
+        else:
+            mask = torch.tensor(feasible, dtype=torch_probs.dtype)
+            log_prob = torch.log(torch_probs[0,action]) \
+                       - torch.log(torch.sum(torch_probs[0] * mask))
+            self._history += [(job, log_prob)]
+        scheduler = self._schedulers[machine]
+        scheduler.schedule(vm)
 
     def placeVM(self, vm):
         if self._reward_f is None:
             self._reward_f = self.Reward_F()
+        if self._batch is not None:
+            return super().placeVM(vm)
         task_info = self._getTaskInfo(vm)
-        state_info = [self._getMachineInfo(machine)
-                        for machine in self._machines]
-        state_info = np.array(state_info)
+        state_info = self._getStateInfo()
         state_info = np.expand_dims(state_info, 0)
         task_info = np.expand_dims(task_info, 0)
-        #  print(state_info, task_info)
-        torch_probs = self._model((state_info, task_info))
-        #  print(torch_probs)
-        c = torch.distributions.Categorical(torch_probs)
-        np_probs = torch_probs.detach().numpy()[0] + 1e-8
-        #  checked = set()
-        #  print("------------------------------------------------")
-        #  print(np_probs)
-        #  print(" - - - - - -")
-        while True:
-            #  action = c.sample()
-            action = np.random.choice(np_probs.shape[-1], p=np_probs)
-            machine = self._machines[action]
-            if machine.isFittable(vm):
-                break
-            np_probs[action] = 0
-            np_probs /= np_probs.sum()
-            #  print(np_probs)
-            #  print(np_probs.sum())
-            #  c = torch.distributions.Categorical(torch_probs)
-            #  checked.add(action.item())
-            #  print('.', end='')
-            #  if len(checked) >= len(self._machines):
-            #      print(checked)
-            #      raise Exception(f"Non of the known machines"
-            #                      f" is suitable for {vm.name}")
-        job = vm._jobScheduler._jobQueue[0]
-        #  self._history += [(job, c.log_prob(action))]
-        self._history += [(job, torch.log(torch_probs[0,action]))]
-        scheduler = self._schedulers[machine]
-        scheduler.schedule(vm)
+        torch_probs = self._evaluate(state_info, task_info)
+        self._sample(vm, state_info, task_info, torch_probs)
+
+    def _record(self, state_info, task_info, feasible, action):
+        """
+        Stores inputs and outcome of decision, returns its index.
+        """
+        n = len(self._history)
+        if self._buffers is None:
+            self._buffers = [np.zeros((256,) + state_info.shape[1:], np.float32),
+                             np.zeros((256,) + task_info.shape[1:], np.float32),
+                             np.zeros((256, len(feasible)), bool),
+                             np.zeros(256, int)]
+        if n == len(self._buffers[-1]):
+            self._buffers = [np.concatenate((b, np.zeros_like(b)))
+                             for b in self._buffers]
+        states, tasks, masks, actions = self._buffers
+        states[n] = state_info[0]
+        tasks[n] = task_info[0]
+        masks[n] = feasible
+        actions[n] = action
+        return n
+
+    def _logProbs(self, n):
+        """
+        Returns masked log-probabilities of first `n` recorded
+        decisions, from one forward pass of the model.
+        """
+        states, tasks, masks, actions = [b[:n] for b in self._buffers]
+        torch_probs = self._model((states, tasks), separate=True)
+        mask = torch.tensor(masks, dtype=torch_probs.dtype)
+        chosen = torch_probs[torch.arange(n), torch.tensor(actions)]
+        return torch.log(chosen) - torch.log(torch.sum(torch_probs * mask, 1))
 
     @staticmethod
     def suff_sum(arr, gamma=1):
@@ -144,22 +263,100 @@ class PolicyGradient(VMPlacementPolicyAI):
         #  print(rewards)
         return rewards
 
-    def step(self):
+    def loss(self):
+        """
+        Returns loss of last run and forgets it.
+        """
         jobs, log_probs = list(zip(*tuple(self._history)))
-        log_probs = torch.stack(log_probs)
+        if self._light_history:
+            log_probs = self._logProbs(len(jobs))
+        else:
+            log_probs = torch.stack(log_probs)
         rewards = self._reward_f(jobs)
         rewards = self.suff_sum(rewards, self._gamma)
         rewards = self.preprocess_rewards(rewards)
         #  print(log_probs.shape)
         #  print(rewards.shape)
         loss = -torch.sum(log_probs * rewards)
-        self._optim.zero_grad()
-        loss.backward()
-        #  self._model.float()
-        self._optim.step()
         # clean last run
         self._reward_f.unregister()
         self._reward_f = None
         self._history = []
+        return loss
+
+    def step(self, loss=None):
+        """
+        Makes learning step on loss of last run,
+        or on given `loss` (e.g. summed over many runs).
+        """
+        if loss is None:
+            loss = self.loss()
+        self._optim.zero_grad()
+        loss.backward()
+        #  self._model.float()
+        self._optim.step()
         return loss.item()
 
+
+
+
+class ParallelPolicyGradient:
+    """
+    Synchronous PolicyGradient training on episodes run by worker
+    processes. Each episode is built by `make_episode`, which creates
+    infrastructure with `PolicyGradient` placement policy (and model
+    replica) in current Simulator, schedules its vms and returns the
+    infrastructure. Workers run episodes with current weights of
+    `model` and send back gradients, which are summed into one update.
+    Episode `i` of step `k` is seeded with
+    `seed + k*n_episodes + i`, whatever the number of workers.
+    """
+    def __init__(self, make_episode, model, lr=0.01,
+                 n_episodes=4, n_workers=4, seed=0):
+        self.model = model
+        self._payload = cloudpickle.dumps(make_episode)
+        self._optim = torch.optim.Adam(model.parameters(), lr=lr)
+        self._n_episodes = n_episodes
+        self._n_workers = n_workers
+        self._seed = seed
+        self._no_steps = 0
+
+    def rollouts(self):
+        """
+        Runs episodes of current step, returns list of
+        (gradients, loss, buffers) of each of them.
+        """
+        state = {k: v.detach().clone() for k, v in self.model.state_dict().items()}
+        first = self._seed + self._no_steps*self._n_episodes
+        seeds = range(first, first + self._n_episodes)
+        if self._n_workers is None or self._n_workers <= 1:
+            return [_rolloutInContext(self._payload, state, seed)
+                    for seed in seeds]
+        return Parallel(n_jobs=self._n_workers)(
+                delayed(_rolloutInContext)(self._payload, state, seed)
+                for seed in seeds
+        )
+
+    def step(self):
+        results = self.rollouts()
+        grads, losses, buffers = zip(*results)
+        self._optim.zero_grad()
+        for p, episodes_grads in zip(self.model.parameters(), zip(*grads)):
+            p.grad = sum(episodes_grads)
+        self._optim.step()
+        # statistics of batch norms gathered by replicas
+        for name, buffer in self.model.named_buffers():
+            values = [b[name] for b in buffers]
+            if buffer.is_floating_point():
+                buffer.copy_(sum(values) / len(values))
+            else:
+                buffer.copy_(max(values))
+        self._no_steps += 1
+        return sum(losses)
+
+    def train(self, n_steps):
+        progress_line = []
+        for _ in range(n_steps):
+            loss = self.step()
+            progress_line += [loss]
+        return progress_line
@@ -16,8 +16,9 @@ class VMPlacementPolicyRandom(VMPlacementPolicySimple):
 
     def placeVM(self, vm):
         np.random.shuffle(self._machines)
+        feasible = self._capacities.feasibleMask(vm)
         for machine in self._machines:
-            if machine.isFittable(vm):
+            if feasible[self._rows[machine]]:
                 scheduler = self._schedulers[machine]
                 scheduler.schedule(vm)
                 return
@@ -26,21 +27,125 @@ class VMPlacementPolicyRandom(VMPlacementPolicySimple):
 
 
 class VMPlacementPolicyAI(VMPlacementPolicySimple):
-    def __init__(self, machines, ModelClass=None):
+
+    class FeatureStore:
+        """
+        Running counts, sums and sums of squares of features of tasks
+        awaiting in VM schedulers' queues, one row per machine, so
+        the state matrix is built without visiting the queues.
+        Sums are centered at the first task queued on a machine, to
+        avoid cancellation in variances. Linear priorities are summed
+        through their coefficients, other are evaluated on demand.
+        """
+        def __init__(self, policy, machines):
+            self._policy = policy
+            self.machines = list(machines)
+            self._rows = {m: i for i, m in enumerate(self.machines)}
+            n, size = len(self.machines), policy._taskInfoSize - 1
+            self.resources = np.array([policy._getResourceInfo(m)
+                                       for m in self.machines], dtype=float)
+            # free ram size changes with allocations
+            self._rams = [[r for r in m.resources if r.rtype == RType.RAM][0]
+                          for m in self.machines]
+            self.counts = np.zeros(n, dtype=int)
+            self.shifts = np.zeros((n, size + 2)) # features, slope, intercept
+            self.sums = np.zeros((n, size))
+            self.squares = np.zeros((n, size))
+            self.coefficients = np.zeros((n, 5)) # A, B, A*A, A*B, B*B
+            self._nonlinear = [{} for _ in self.machines] # {vm: jobs}
+            self._tasks = {} # {vm: (features, slope, intercept)}
+            for machine in self.machines:
+                # policies sharing machines keep separate stores
+                machine._vmScheduler._features[policy] = self
+                for vm in machine._vmScheduler.vms:
+                    self.add(machine, vm)
+
+        def add(self, machine, vm):
+            i = self._rows[machine]
+            features, coefficients = self._policy._getTaskFeatures(vm)
+            if self.counts[i] == 0:
+                self.shifts[i, :-2] = features
+                self.shifts[i, -2:] = coefficients or (0, 0)
+            if coefficients is None:
+                self._nonlinear[i][vm] = vm._jobScheduler._jobQueue[:]
+            self._tasks[vm] = (features, coefficients)
+            self._accumulate(i, vm, 1)
+
+        def remove(self, machine, vm):
+            i = self._rows[machine]
+            self._accumulate(i, vm, -1)
+            del self._tasks[vm]
+            self._nonlinear[i].pop(vm, None)
+            if self.counts[i] == 0:
+                # drop rounding errors accumulated in the row
+                for arr in (self.shifts, self.sums, self.squares,
+                            self.coefficients):
+                    arr[i] = 0
+
+        def _accumulate(self, i, vm, sign):
+            features, coefficients = self._tasks[vm]
+            x = features - self.shifts[i, :-2]
+            self.counts[i] += sign
+            self.sums[i] += sign*x
+            self.squares[i] += sign*x*x
+            if coefficients is not None:
+                a = coefficients[0] - self.shifts[i, -2]
+                b = coefficients[1] - self.shifts[i, -1]
+                self.coefficients[i] += sign*np.array([a, b, a*a, a*b, b*b])
+
+        def state(self, time):
+            """
+            Returns np.array of infos of all machines,
+            as `VMPlacementPolicyAI._getMachineInfo` at `time`.
+            """
+            centers = self.shifts[:, -2]*time + self.shifts[:, -1]
+            A, B, AA, AB, BB = self.coefficients.T
+            pSums = A*time + B
+            pSquares = AA*time*time + 2*AB*time + BB
+            for i, vms in enumerate(self._nonlinear):
+                for jobs in vms.values():
+                    p = sum([job.priority for job in jobs]) - centers[i]
+                    pSums[i] += p
+                    pSquares[i] += p*p
+            counts = self.counts[:, None]
+            sums = np.column_stack((self.sums, pSums))
+            squares = np.column_stack((self.squares, pSquares))
+            shifts = np.column_stack((self.shifts[:, :-2], centers))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                means = sums / counts
+                stds = np.sqrt(np.maximum(squares / counts - means*means, 0))
+            totals = sums[:, :2] + counts*shifts[:, :2]
+            vmsInfo = np.column_stack((counts, totals, means + shifts, stds))
+            vmsInfo[self.counts == 0] = 0
+            self.resources[:, 2] = [ram.value for ram in self._rams]
+            return np.column_stack((self.resources, vmsInfo))
+
+    def __init__(self, machines, ModelClass=None, batch=None):
+        """
+        `batch` set to 'exact' or 'approximate' defers placements
+        to the end of time instant, see `_placePending`. With 'external' deferred placements
+        wait for scores from outside, see `VectorizedEnvironment`.
+        """
         super().__init__(machines)
+        assert batch in (None, 'exact', 'approximate', 'external')
+        self._batch = batch
+        self._pending = []
+        self._awaiting = None # vms waiting for external scores
         self._machines = list(machines)[:]
         self._taskInfoSize = 6
         self._machineInfoSize = 2*self._taskInfoSize + 3 + 3
         self._model = ModelClass((len(self._machines), self._machineInfoSize),
                                  self._taskInfoSize, len(self._machines))
+        self._features = self.FeatureStore(self, self._machines)
 
     @staticmethod
-    def _getTaskInfo(task):
+    def _getTaskFeatures(task):
         """
-        Returns np.array of
+        Returns np.array of time independent features of given task
         [cpu length, gpu length, number of threads,
-        number of gpus, requested ram size, priority]
-        of given task.
+        number of gpus, requested ram size]
+        and (slope, intercept) of its total priority,
+        or None if priority of some of its jobs is not linear.
         """
         request = task._resourceRequest
         rams = list(filter(lambda r: r.rtype == RType.RAM, request))
@@ -51,23 +156,47 @@ class VMPlacementPolicyAI(VMPlacementPolicySimple):
         assert len(jobs) > 0
         cpu_ops = sum([job.operations.get(RType.CPU_core, 0) for job in jobs])
         gpu_ops = sum([job.operations.get(RType.GPU, 0) for job in jobs])
-        priority = sum([job.priority for job in jobs])
-        info = [cpu_ops, gpu_ops, len(cores), len(gpus), rams[0].value, priority]
-        return np.array(info)
+        features = [cpu_ops, gpu_ops, len(cores), len(gpus), rams[0].value]
+        coefficients = [job.linearPriority for job in jobs]
+        if None in coefficients:
+            coefficients = None
+        else:
+            coefficients = tuple([sum(c) for c in zip(*coefficients)])
+        return np.array(features, dtype=float), coefficients
 
-    def _getMachineInfo(self, machine):
+    @staticmethod
+    def _getTaskInfo(task):
         """
         Returns np.array of
-        [number of cores, number of gpus, ram size,
-        number of awaiting tasks, their total cpu and gpu lengths,
-        and means and standard deviations of awaiting tasks parameters]
+        [cpu length, gpu length, number of threads,
+        number of gpus, requested ram size, priority]
+        of given task.
+        """
+        features, _ = VMPlacementPolicyAI._getTaskFeatures(task)
+        jobs = task._jobScheduler._jobQueue
+        priority = sum([job.priority for job in jobs])
+        return np.append(features, priority)
+
+    @staticmethod
+    def _getResourceInfo(machine):
+        """
+        Returns [number of cores, number of gpus, ram size] of machine.
         """
         rams = list(filter(lambda r: r.rtype == RType.RAM, machine.resources))
         assert len(rams) == 1
         cores = list(filter(lambda r: r.rtype == RType.CPU_core, machine.resources))
         assert len(cores) > 0
         gpus = list(filter(lambda r: r.rtype == RType.GPU, machine.resources))
-        resource_info = [len(cores), len(gpus), rams[0].value]
+        return [len(cores), len(gpus), rams[0].value]
+
+    def _getMachineInfo(self, machine):
+        """
+        Returns np.array of
+        [number of cores, number of gpus, ram size,
+        number of awaiting tasks, their total cpu and gpu lengths,
+        and means and standard deviations of awaiting tasks parameters]
+        """
+        resource_info = self._getResourceInfo(machine)
         vms = machine._vmScheduler.vms
         if len(vms) > 0:
             vms_data = np.array([self._getTaskInfo(vm) for vm in vms])
@@ -83,22 +212,112 @@ class VMPlacementPolicyAI(VMPlacementPolicySimple):
         info = np.concatenate((resource_info, vms_info))
         return info
 
-    def placeVM(self, vm):
-        task_info = self._getTaskInfo(vm)
-        state_info = [self._getMachineInfo(machine) for machine in self._machines]
-        state_info = np.array(state_info)
-        # add batch dimension
-        state_info = np.expand_dims(state_info, 0)
-        task_info = np.expand_dims(task_info, 0)
-        scores = self._model.predict((state_info, task_info))
-        # remove batch dimension
-        scores = scores[0]
+    def _getStateInfo(self):
+        """
+        Returns np.array of infos of all machines, kept by feature store.
+        """
+        return self._features.state(NOW())
+
+    def _evaluate(self, state_info, task_info):
+        """
+        Returns scores of machines for batch of states and tasks.
+        """
+        return self._model.predict((state_info, task_info))
+
+    def _observe(self, vms):
+        """
+        Returns batch of (state info, task info) for `vms`,
+        all in the current state.
+        """
+        task_info = np.array([self._getTaskInfo(vm) for vm in vms])
+        state_info = self._getStateInfo()
+        # the same state for each task in batch
+        state_info = np.repeat(np.expand_dims(state_info, 0), len(vms), 0)
+        return state_info, task_info
+
+    def _score(self, task_info):
+        """
+        Returns scores of machines for each row of `task_info`,
+        from one model call on the current state.
+        """
+        state_info = self._getStateInfo()
+        # the same state for each task in batch
+        state_info = np.repeat(np.expand_dims(state_info, 0), len(task_info), 0)
+        return self._evaluate(state_info, task_info)
+
+    def _placeByScores(self, vm, scores):
         ordered_indices = np.argsort(-scores)
+        feasible = self._capacities.feasibleMask(vm)
         for i in ordered_indices:
             machine = self._machines[i]
-            if machine.isFittable(vm):
+            if feasible[self._rows[machine]]:
                 scheduler = self._schedulers[machine]
                 scheduler.schedule(vm)
                 return
         raise Exception(f"Non of the known machines is suitable for {vm.name}")
 
+    def _placeScored(self, vms, state_info, task_info, scores):
+        """
+        Places `vms` in order, by corresponding rows of `scores`.
+        """
+        for vm, vmScores in zip(vms, scores):
+            self._placeByScores(vm, vmScores)
+
+    def _placed(self, vms):
+        notif = Notification(NType.Other, message="VMPlacement", vms=vms)
+        Simulator.getInstance().emit(notif)
+
+    def _placePending(self):
+        """
+        Places vms requested at this time instant in order.
+        All pending vms are scored in one model call. With 'approximate'
+        batching all are placed by these scores, computed on the state
+        from before the first placement. With 'exact' only the first one
+        is placed, and the remaining are rescored together in following
+        event, on the state updated by the placement and allocations it
+        triggered (so n vms take n model calls, on n, n-1, ..., 1 rows).
+        Placement events have priority below other same-time events, so
+        only events triggered by placements run between them.
+        With 'external' they are left awaiting `placeAwaiting` call.
+        """
+        vms, self._pending = self._pending, []
+        if self._batch == 'external':
+            self._awaiting = vms
+            return
+        state_info, task_info = self._observe(vms)
+        scores = self._evaluate(state_info, task_info)
+        if self._batch == 'exact':
+            vms, self._pending = vms[:1], vms[1:]
+            state_info, task_info = state_info[:1], task_info[:1]
+            scores = scores[:1]
+            if len(self._pending) > 0:
+                self._addPlacementEvent()
+        self._placeScored(vms, state_info, task_info, scores)
+        self._placed(vms)
+
+    def _addPlacementEvent(self):
+        # after all placement requests at this time
+        event = Event(self._placePending, name="VMBatchPlacement",
+                      priority=-50)
+        Simulator.getInstance().addEvent(NOW(), event)
+
+    def placeAwaiting(self, state_info, task_info, scores):
+        """
+        Places awaiting vms by scores computed outside
+        on the batch returned by `_observe(self._awaiting)`.
+        """
+        vms, self._awaiting = self._awaiting, None
+        self._placeScored(vms, state_info, task_info, scores)
+        self._placed(vms)
+
+    def placeVM(self, vm):
+        if self._batch is not None:
+            self._pending += [vm]
+            if len(self._pending) == 1:
+                self._addPlacementEvent()
+            return
+        # add batch dimension
+        task_info = np.expand_dims(self._getTaskInfo(vm), 0)
+        scores = self._score(task_info)
+        # remove batch dimension
+        self._placeByScores(vm, scores[0])
@@ -1,3 +1,5 @@
+import heapq
+import numpy as np
 from sortedcontainers import SortedDict, SortedSet
 import json
 
@@ -103,6 +105,154 @@ class Map(SortedDict):
         return key_
 
 
+class KineticHeap:
+    """
+    Max-heap of items with keys changing linearly in time,
+    `slope*time + intercept`. Times are expected not to go back;
+    if they do (e.g. reset simulation clock), heap is rebuilt.
+    Equal keys are ordered by time of first insertion of an item.
+    Each parent-child pair has a certificate, failing when the child
+    overtakes the parent; certificates failed until requested time
+    are repaired by swaps, so finding the maximum is logarithmic.
+    """
+
+    def __init__(self, time=0):
+        self._time = time
+        self._heap = [] # [item]
+        self._pos = {} # {item: position in self._heap}
+        self._keys = {} # {item: (slope, intercept, seq)}
+        self._stamps = {} # {item: stamp of its current certificate}
+        self._events = [] # heap of (failure time, stamp, item)
+        self._seq = 0
+        self._stamp = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, item):
+        return item in self._pos
+
+    def _greater(self, a, b):
+        sa, ia, qa = self._keys[a]
+        sb, ib, qb = self._keys[b]
+        va = sa*self._time + ia
+        vb = sb*self._time + ib
+        return va > vb or (va == vb and qa < qb)
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._pos[heap[i]] = i
+        self._pos[heap[j]] = j
+
+    def _siftUp(self, i, touched):
+        while i > 0 and self._greater(self._heap[i], self._heap[(i-1)//2]):
+            self._swap(i, (i-1)//2)
+            touched.add(i)
+            i = (i-1)//2
+        touched.add(i)
+        return i
+
+    def _siftDown(self, i, touched):
+        n = len(self._heap)
+        while True:
+            touched.add(i)
+            best = i
+            for child in (2*i + 1, 2*i + 2):
+                if child < n and self._greater(self._heap[child], self._heap[best]):
+                    best = child
+            if best == i:
+                return
+            self._swap(i, best)
+            i = best
+
+    def _certify(self, touched):
+        """
+        Renews certificates of given positions and their children.
+        """
+        n = len(self._heap)
+        positions = set()
+        for i in touched:
+            positions.update(k for k in (i, 2*i + 1, 2*i + 2) if k < n)
+        for k in positions:
+            child = self._heap[k]
+            if k == 0:
+                # root has no certificate
+                self._stamps[child] = None
+                continue
+            parent = self._heap[(k-1)//2]
+            self._stamp += 1
+            self._stamps[child] = self._stamp
+            sc, ic, _ = self._keys[child]
+            sp, ip, _ = self._keys[parent]
+            if sc <= sp:
+                continue
+            failure = max((ip - ic) / (sc - sp), self._time)
+            heapq.heappush(self._events, (failure, self._stamp, child))
+
+    def _fix(self, i):
+        touched = set()
+        self._siftDown(self._siftUp(i, touched), touched)
+        self._certify(touched)
+
+    def push(self, item, slope, intercept):
+        self._keys[item] = (slope, intercept, self._seq)
+        self._seq += 1
+        self._heap += [item]
+        self._pos[item] = len(self._heap) - 1
+        self._fix(len(self._heap) - 1)
+
+    def update(self, item, slope, intercept):
+        self._keys[item] = (slope, intercept, self._keys[item][2])
+        self._fix(self._pos[item])
+
+    def remove(self, item):
+        i = self._pos.pop(item)
+        del self._keys[item]
+        self._stamps.pop(item, None)
+        last = self._heap.pop()
+        if i < len(self._heap):
+            self._heap[i] = last
+            self._pos[last] = i
+            self._fix(i)
+
+    def _rebuild(self, time):
+        """
+        Builds heap anew at `time`, keeping order of insertions.
+        """
+        keys = self._keys
+        items = sorted(keys, key=lambda item: keys[item][2])
+        self.__init__(time)
+        for item in items:
+            self.push(item, *keys[item][:2])
+
+    def advance(self, time):
+        if time < self._time:
+            self._rebuild(time)
+            return
+        self._time = time
+        while len(self._events) > 0 and self._events[0][0] <= time:
+            _, stamp, child = heapq.heappop(self._events)
+            if self._stamps.get(child) != stamp:
+                continue
+            i = self._pos[child]
+            parent = self._heap[(i-1)//2]
+            if self._greater(child, parent):
+                self._fix(i)
+            else:
+                # not ahead yet because of ties or rounding of failure time
+                self._stamp += 1
+                self._stamps[child] = self._stamp
+                later = np.nextafter(time, INF)
+                heapq.heappush(self._events, (later, self._stamp, child))
+
+    def top(self, time=None):
+        if time is not None:
+            self.advance(time)
+        return self._heap[0]
+
+
+
 def dictMinus(d0, d1):
     ans = {}
     for i in set(d0.keys()).union(d1.keys()):
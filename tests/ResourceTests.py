@@ -1,4 +1,5 @@
 import nose
+import random
 from tests.base_test import *
 from Simulator import *
 from Listeners import EventInspector
@@ -188,3 +189,123 @@ class ResourceTests(SimulatorTests):
         sim.simulate()
         inspector.verify()
 
+
+
+    def test_recalculationCoalesced(self):
+        inf = INF
+        resources = {
+            Resource(RType.CPU_core, 10), # GHz
+            Resource(RType.RAM, 16),      # GB
+        }
+        m0 = Machine("m0", resources)
+        jobs = [Job(100, [ResourceRequest(RType.CPU_core, inf),
+                          ResourceRequest(RType.RAM, 1)]) for _ in range(4)]
+
+        sim = Simulator.getInstance()
+        for job in jobs:
+            sim.addEvent(0, JobStart(job, m0))
+
+        recalculated = EventInspector()
+        for job in jobs[:3]:
+            recalculated.addExpectation(what=NType.JobRecalculate, time=0, job=job)
+        recalculated.addExpectation(what=NType.JobRecalculate)
+        sim.simulate()
+        assert sim.time == 40
+        # each job recalculated once, no more recalculations left
+        assert len(recalculated._expectations) == 1
+
+
+    def test_usageCounters(self):
+        inf = INF
+        core = Resource(RType.CPU_core, 10) # GHz
+        ram = Resource(RType.RAM, 16)       # GB
+        m0 = Machine("m0", {core, ram})
+        job0 = Job(100, [ResourceRequest(RType.CPU_core, inf),
+                         ResourceRequest(RType.CPU_core, inf),
+                         ResourceRequest(RType.RAM, 1)])
+        job1 = Job(100, [ResourceRequest(RType.CPU_core, inf),
+                         ResourceRequest(RType.RAM, 1)])
+        vm = VirtualMachine("vm0", [ResourceRequest(RType.CPU_core, inf, shared=True),
+                                    ResourceRequest(RType.RAM, 2)])
+        for holder in [job0, job1, vm]:
+            assert m0.allocate(holder)
+        assert core.noDynamicUses == 3
+        assert core.noJobsUsing == 2 and core.jobsUsing == {job0, job1}
+        assert core.noVMsUsing == 1 and core.vmsUsing == {vm}
+        assert m0.noJobsUsing == 2 and m0.noVMsUsing == 1
+        assert ram.noDynamicUses == 0 and ram.noJobsUsing == 2
+        m0.free(job0)
+        assert core.noDynamicUses == 1
+        assert core.jobsUsing == {job1}
+        m0.free(vm)
+        m0.free(job1)
+        assert core.noDynamicUses == 0
+        assert core.noJobsUsing == 0 and core.noVMsUsing == 0
+        assert m0.noJobsUsing == 0 and m0.noVMsUsing == 0
+
+
+    def test_resourcesIndex(self):
+        random.seed(0)
+        resources = {Resource(RType.RAM, 64)}
+        for freq in [1, 1, 2, 2, 2, 3, 4, 4]:
+            resources.add(Resource(RType.CPU_core, freq))
+        m0 = Machine("m0", resources)
+        index = m0._resourcesIndex
+
+        def bestFitting(req):
+            try:
+                return m0.getBestFitting(req)
+            except RuntimeError as e:
+                return e.args[0]
+
+        def getReq():
+            value = random.choice([INF, 0.5, 1, 2, 3, 4, 5])
+            return ResourceRequest(RType.CPU_core, value,
+                                   shared=random.random() < 0.5)
+
+        allocated = []
+        for _ in range(200):
+            if len(allocated) > 0 and random.random() < 0.4:
+                holder = allocated.pop(random.randrange(len(allocated)))
+                m0.free(holder)
+            else:
+                noCores = random.randint(1, 3)
+                req = [getReq() for _ in range(noCores)]
+                job = Job(100, req + [ResourceRequest(RType.RAM, 1)])
+                if m0.allocate(job, noexcept=True):
+                    allocated += [job]
+            for _ in range(5):
+                req = getReq()
+                indexed = bestFitting(req)
+                m0._resourcesIndex = None
+                scanned = bestFitting(req)
+                m0._resourcesIndex = index
+                assert indexed is scanned or indexed == scanned
+
+
+    def test_failedAllocationRollback(self):
+        inf = INF
+        core = Resource(RType.CPU_core, 10) # GHz
+        ram = Resource(RType.RAM, 8)        # GB
+        m0 = Machine("m0", {core, ram})
+        job0 = Job(100, [ResourceRequest(RType.CPU_core, inf),
+                         ResourceRequest(RType.RAM, 4)])
+        job1 = Job(100, [ResourceRequest(RType.CPU_core, inf),
+                         ResourceRequest(RType.RAM, 2)])
+        job2 = Job(100, [ResourceRequest(RType.CPU_core, inf),
+                         ResourceRequest(RType.RAM, 6)])
+        sim = Simulator.getInstance()
+        sim.addEvent(0, JobStart(job0, m0))
+        sim.addEvent(5, JobStart(job1, m0))
+        sim.addEvent(8, Event(lambda: None))
+        while sim._eventQueue._currentTime < 8:
+            sim._eventQueue.proceed()
+
+        state = (core.snapshot(), ram.snapshot(), core.noDynamicUses)
+        assert not m0.canAllocate(job2)
+        assert not m0.allocate(job2, noexcept=True)
+        assert state == (core.snapshot(), ram.snapshot(), core.noDynamicUses)
+        assert job2.isAllocated == 0 and not core.isUsedBy(job2)
+        assert sim._recalculation is None
+        sim.simulate()
+        assert sim.time == 20
@@ -1,4 +1,5 @@
 import nose
+import numpy as np
 from tests.base_test import *
 from Simulator import *
 from Listeners import EventInspector
@@ -270,3 +271,516 @@ class SchedulersTests(SimulatorTests):
         sim.simulate()
         inspector.verify()
 
+
+    def test_capacityClasses(self):
+        def getMachine(name, ram):
+            resources = {
+                Resource(RType.CPU_core, 10),           # GHz
+                Resource(RType.CPU_core, 10),           # GHz
+                Resource(RType.RAM, ram),               # GB
+            }
+            return Machine(name, resources, lambda m: None, VMSchedulerSimple)
+        machines = [getMachine("m0", 8), getMachine("m1", 16),
+                    getMachine("m2", 16), getMachine("m3", 16)]
+        infrastructure = Infrastructure(machines, VMPlacementPolicySimple)
+        assert sorted(len(c.machines) for c in infrastructure.capacityClasses) == [1, 3]
+
+        def getVM(name, ram):
+            resourceReq = [
+                ResourceRequest(RType.CPU_core, INF, shared=True),
+                ResourceRequest(RType.RAM, ram),
+            ]
+            return VirtualMachine(name, resourceReq,
+                    lambda machine: JobSchedulerSimple(machine, autofree=True))
+        for ram in (4, 12, 24):
+            vm = getVM(f"vm{ram}", ram)
+            for machine in machines:
+                assert machine.isFittable(vm) == machine._checkFittable(vm)
+        for c in infrastructure.capacityClasses:
+            assert len(c._fittable) == 3
+
+    def test_feasibleMask(self):
+        rng = np.random.RandomState(0)
+        machines = []
+        for i in range(12):
+            resources = {Resource(RType.RAM, int(rng.choice([8, 16])))}
+            for _ in range(rng.randint(1, 4)):
+                resources.add(Resource(RType.CPU_core, int(rng.choice([2, 4]))))
+            for _ in range(rng.randint(0, 3)):
+                resources.add(Resource(RType.GPU, int(rng.choice([512, 1024])), 1))
+            machines += [Machine(f"m{i}", resources,
+                                 lambda m: None, VMSchedulerSimple)]
+        infrastructure = Infrastructure(machines, VMPlacementPolicySimple)
+        policy = infrastructure._vmPlacementPolicy
+        assert policy._capacities is infrastructure.capacities
+        assert CapacityMatrix.shared(machines[:3]) is not infrastructure.capacities
+        for i in range(50):
+            request = [ResourceRequest(RType.RAM, int(rng.randint(1, 20)))]
+            for _ in range(rng.randint(1, 4)):
+                value = INF if rng.rand() < 0.5 else int(rng.randint(1, 5))
+                request += [ResourceRequest(RType.CPU_core, value)]
+            for _ in range(rng.randint(0, 3)):
+                request += [ResourceRequest(RType.GPU, int(rng.randint(1, 1200)))]
+            vm = VirtualMachine(f"vm{i}", request)
+            mask = infrastructure.feasibleMask(vm)
+            expected = [m.isFittable(vm) for m in infrastructure.capacities.machines]
+            assert list(mask) == expected
+
+        m0 = infrastructure.capacities.machines[0]
+        vm = VirtualMachine("vm", [ResourceRequest(RType.RAM, 8)])
+        ram = 2
+        before = infrastructure.capacities.free[0, ram]
+        m0.allocate(vm)
+        assert infrastructure.capacities.free[0, ram] == before - 8
+        m0.free(vm)
+        assert infrastructure.capacities.free[0, ram] == before
+
+    def test_pickleInfrastructure(self):
+        import pickle
+        machines = []
+        for i in range(3):
+            resources = {Resource(RType.RAM, 16)}
+            for _ in range(i + 1):
+                resources.add(Resource(RType.CPU_core, 2*(i + 1)))
+            machines += [Machine(f"m{i}", resources,
+                                 lambda m: None, VMSchedulerSimple)]
+        infrastructure = Infrastructure(machines, VMPlacementPolicySimple)
+        vm = VirtualMachine("vm", [ResourceRequest(RType.RAM, 8),
+                                   ResourceRequest(RType.CPU_core, INF)])
+        machines[2].allocate(vm)
+        copy = pickle.loads(pickle.dumps(infrastructure))
+        copies = copy.capacities.machines
+        assert [m.name for m in copies] == ["m0", "m1", "m2"]
+        assert copy._vmPlacementPolicy._capacities is copy.capacities
+        assert (copy.capacities.free == infrastructure.capacities.free).all()
+        other = VirtualMachine("other", [ResourceRequest(RType.RAM, 8),
+                                         ResourceRequest(RType.CPU_core, INF)])
+        assert list(copy.feasibleMask(other)) == \
+               list(infrastructure.feasibleMask(other))
+        # resources index of unpickled machine follows allocations
+        copies[2].allocate(other)
+        assert copies[2].noVMsUsing == 2
+        third = VirtualMachine("third", [ResourceRequest(RType.RAM, 8)])
+        assert not copies[2].canAllocate(third)
+        assert machines[2].canAllocate(third)
+        assert machines[2].noVMsUsing == 1
+
+    def test_featureStore(self):
+        from Generator import CreateVM
+        from scheduling.Models import Model_v0_np
+        from scheduling.VMPlacementPolicies import VMPlacementPolicyAI
+        rng = np.random.RandomState(1)
+        machines = []
+        for i in range(4):
+            resources = {Resource(RType.RAM, 64)}
+            for _ in range(i + 1):
+                resources.add(Resource(RType.CPU_core, 2))
+            machines += [Machine(f"m{i}", resources,
+                                 lambda m: None, VMSchedulerSimple)]
+        infrastructure = Infrastructure(machines, lambda ms:
+                VMPlacementPolicyAI(ms, ModelClass=Model_v0_np))
+        # another policy over part of the machines
+        policies = [infrastructure._vmPlacementPolicy,
+                    VMPlacementPolicyAI(machines[:2], ModelClass=Model_v0_np)]
+        priorities = [3, LinearPriority(0.5, 1), lambda t: 1 + t*t/10]
+        sim = Simulator.getInstance()
+        queued = []
+        for i in range(40):
+            jobs = []
+            for _ in range(rng.randint(1, 3)):
+                request = [ResourceRequest(RType.RAM, int(rng.randint(1, 4))),
+                           ResourceRequest(RType.CPU_core, INF)]
+                priority = priorities[rng.randint(3)]
+                jobs += [Job(int(rng.randint(1, 100)), request, priority=priority)]
+            vm = CreateVM.minimal(jobs)
+            for job in jobs:
+                vm._jobScheduler.schedule(job)
+            machine = machines[rng.randint(4)]
+            machine._vmScheduler.schedule(vm)
+            queued += [machine]
+            if rng.rand() < 0.3:
+                machine = queued.pop(rng.randint(len(queued)))
+                if machine._vmScheduler.noVMsLeft > 0:
+                    machine._vmScheduler.popFront()
+            sim._eventQueue._currentTime = i/2
+            for policy in policies:
+                expected = [policy._getMachineInfo(m) for m in policy._machines]
+                assert np.allclose(policy._getStateInfo(), expected)
+
+    def test_batchPlacement(self):
+        from Generator import CreateVM, VMDelayScheduler
+        from scheduling.Models import Model_v0_np
+        from scheduling.VMPlacementPolicies import VMPlacementPolicyAI
+        rng = np.random.RandomState(2)
+        model = Model_v0_np((4, 18), 6, 4)
+        model.setVars([rng.uniform(-1, 1, var.shape) for var in model.getVars()])
+        calls = []
+        fresh = {}
+        class Policy(VMPlacementPolicyAI):
+            def _placeByScores(self, vm, scores):
+                # compare with scores on the state at placement time
+                current = Model_v0_np.__call__(self._model, self._observe([vm]))
+                fresh[self._batch] += [np.allclose(scores, current[0])]
+                super()._placeByScores(vm, scores)
+        class Recorder(NotificationListener):
+            def __init__(self):
+                self.log = []
+                self.subscribe(NType.VMStart)
+            def notify(self, notif):
+                self.log += [(notif.time, notif.vm, notif.host.name)]
+        starts = {}
+        for batch in (None, 'exact', 'approximate'):
+            Simulator.getInstance().clear()
+            fresh[batch] = []
+            rng = np.random.RandomState(3)
+            machines = []
+            for i in range(4):
+                resources = {Resource(RType.RAM, 16*(i + 1))}
+                for _ in range(i + 2):
+                    resources.add(Resource(RType.CPU_core, 2))
+                machines += [Machine(f"m{i}", resources,
+                                     lambda m: None, VMSchedulerSimple)]
+            def Model(*args):
+                m = Model_v0_np(*args)
+                m.setVars(model.getVars())
+                predict = m.predict
+                m.predict = lambda inp: calls.append((batch, len(inp[1]))) \
+                                          or predict(inp)
+                return m
+            infrastructure = Infrastructure(machines, lambda ms:
+                    Policy(ms, ModelClass=Model, batch=batch))
+            vms = []
+            for i in range(30):
+                request = [ResourceRequest(RType.RAM, int(rng.randint(1, 8)))]
+                request += int(rng.randint(1, 4))*[ResourceRequest(RType.CPU_core, INF)]
+                job = Job(int(rng.randint(1, 100)), request,
+                          priority=LinearPriority(rng.rand(), 1))
+                vm = CreateVM.minimal([job])
+                vm.scheduleJob(job)
+                vms += [vm]
+            times = [float(i // 10 * 20) for i in range(len(vms))]
+            VMDelayScheduler(infrastructure).scheduleVM(vms, times=times)
+            recorder = Recorder()
+            Simulator.getInstance().simulate()
+            starts[batch] = [(time, vms.index(vm), host)
+                             for time, vm, host in recorder.log]
+        assert len(set([host for _, _, host in starts[None]])) > 1
+        for batch in starts:
+            assert len(starts[batch]) == len(vms)
+        assert all(fresh[None]) and all(fresh['exact'])
+        assert not all(fresh['approximate'])
+        rows = {batch: [n for b, n in calls if b == batch]
+                for batch in (None, 'exact', 'approximate')}
+        assert rows[None] == len(vms)*[1]
+        # one call for each instant, then rescoring of the remaining vms
+        assert rows['exact'] == 3*list(range(10, 0, -1))
+        assert rows['approximate'] == 3*[10]
+
+    def test_policyGradientMask(self):
+        import torch
+        from Generator import CreateVM
+        from scheduling.Models import Model_v0_torch
+        from scheduling.Trainers import PolicyGradient
+        machines = []
+        for i in range(6):
+            resources = {Resource(RType.RAM, 16), Resource(RType.CPU_core, 2)}
+            if i == 4:
+                resources.add(Resource(RType.GPU, 1024, 1))
+            machines += [Machine(f"m{i}", resources,
+                                 lambda m: None, VMSchedulerSimple)]
+        infrastructure = Infrastructure(machines, lambda ms:
+                PolicyGradient(ms, ModelClass=Model_v0_torch))
+        policy = infrastructure._vmPlacementPolicy
+        policy._model.eval()
+        for i in range(5):
+            request = [ResourceRequest(RType.RAM, 1),
+                       ResourceRequest(RType.CPU_core, INF),
+                       ResourceRequest(RType.GPU, 512)]
+            job = Job(10, request)
+            vm = CreateVM.minimal([job])
+            vm._jobScheduler.schedule(job)
+            infrastructure.scheduleVM(vm)
+            assert vm in machines[4]._vmScheduler.vms
+            # the only feasible machine is chosen with probability 1
+            _, log_prob = policy._history[-1]
+            assert abs(log_prob.item()) < 1e-6
+            assert log_prob.requires_grad
+        assert len(policy._history) == 5
+        policy._reward_f.unregister()
+
+    def test_policyGradientLightHistory(self):
+        import torch
+        from Generator import CreateVM
+        from scheduling.Models import Model_v0_torch
+        from scheduling.Trainers import PolicyGradient
+        policies = []
+        for light in (False, True):
+            machines = []
+            for i in range(5):
+                resources = {Resource(RType.RAM, 16*(i + 1))}
+                for _ in range(i + 1):
+                    resources.add(Resource(RType.CPU_core, 2))
+                machines += [Machine(f"m{i}", resources,
+                                     lambda m: None, VMSchedulerSimple)]
+            infrastructure = Infrastructure(machines, lambda ms:
+                    PolicyGradient(ms, ModelClass=Model_v0_torch,
+                                   light_history=light))
+            policies += [infrastructure._vmPlacementPolicy]
+        full, light = policies
+        light._model.load_state_dict(full._model.state_dict())
+        placed = []
+        for policy in policies:
+            vms = []
+            rng = np.random.RandomState(3)
+            np.random.seed(3)
+            for i in range(300):
+                request = [ResourceRequest(RType.RAM, int(rng.randint(1, 16)))]
+                request += int(rng.randint(1, 3))*[ResourceRequest(RType.CPU_core, INF)]
+                job = Job(int(rng.randint(1, 100)), request,
+                          priority=LinearPriority(rng.rand(), 1))
+                vm = CreateVM.minimal([job])
+                vm._jobScheduler.schedule(job)
+                policy.placeVM(vm)
+                vms += [vm]
+            policy._reward_f.unregister()
+            placed += [[[vms.index(vm) for vm in m._vmScheduler.vms]
+                        for m in policy._machines]]
+        assert [n for _, n in light._history] == list(range(300))
+        assert placed[0] == placed[1]
+        assert sum([len(vms) > 0 for vms in placed[0]]) > 1
+        expected = torch.stack([log_prob for _, log_prob in full._history])
+        log_probs = light._logProbs(300)
+        assert torch.allclose(log_probs, expected, atol=1e-5)
+        expected.sum().backward()
+        log_probs.sum().backward()
+        for p, q in zip(full._model.parameters(), light._model.parameters()):
+            assert torch.allclose(p.grad, q.grad, rtol=1e-4, atol=1e-5)
+        assert torch.equal(full._model.bn0.running_mean,
+                           light._model.bn0.running_mean)
+
+    def test_policyGradientBatch(self):
+        import torch
+        from Generator import CreateVM, VMDelayScheduler
+        from scheduling.Models import Model_v0_torch
+        from scheduling.Trainers import PolicyGradient
+        for batch in ('exact', 'approximate'):
+            machines = []
+            for i in range(3):
+                resources = {Resource(RType.RAM, 16)}
+                for _ in range(2*i + 1):
+                    resources.add(Resource(RType.CPU_core, 2))
+                machines += [Machine(f"m{i}", resources,
+                                     lambda m: None, VMSchedulerSimple)]
+            infrastructure = Infrastructure(machines, lambda ms:
+                    PolicyGradient(ms, ModelClass=Model_v0_torch, batch=batch))
+            policy = infrastructure._vmPlacementPolicy
+            vms = []
+            for _ in range(30):
+                request = [ResourceRequest(RType.RAM, int(np.random.randint(1, 8))),
+                           ResourceRequest(RType.CPU_core, INF)]
+                job = Job(int(np.random.randint(1, 100)), request,
+                          priority=LinearPriority(np.random.rand(), 1))
+                vm = CreateVM.minimal([job])
+                vm.scheduleJob(job)
+                vms += [vm]
+            # many vms requested at the same times
+            times = [float(i % 3) for i in range(len(vms))]
+            VMDelayScheduler(infrastructure).scheduleVM(vms, times=times)
+            Simulator.getInstance().simulate()
+            assert len(policy._history) == len(vms)
+            assert all(log_prob.requires_grad for _, log_prob in policy._history)
+            assert np.isfinite(policy.step())
+            Simulator.getInstance().clear()
+
+    def test_vectorizedEnvironment(self):
+        import torch
+        from Generator import CreateVM, VMDelayScheduler
+        from scheduling.Models import Model_v0_np, Model_v0_torch
+        from scheduling.VMPlacementPolicies import VMPlacementPolicyAI
+        from scheduling.Trainers import PolicyGradient
+        from scheduling.Environments import VectorizedEnvironment
+        def getSimulation(seed, Policy):
+            sim = Simulator()
+            with sim:
+                rng = np.random.RandomState(seed)
+                machines = []
+                for i in range(3):
+                    resources = {Resource(RType.RAM, 16)}
+                    for _ in range(2*i + 1):
+                        resources.add(Resource(RType.CPU_core, 2))
+                    machines += [Machine(f"m{i}", resources,
+                                         lambda m: None, VMSchedulerSimple)]
+                infrastructure = Infrastructure(machines, Policy)
+                vms = []
+                for _ in range(40):
+                    request = [ResourceRequest(RType.RAM, int(rng.randint(1, 8))),
+                               ResourceRequest(RType.CPU_core, INF)]
+                    job = Job(int(rng.randint(1, 100)), request,
+                              priority=LinearPriority(rng.rand(), 1))
+                    vm = CreateVM.minimal([job])
+                    vm.scheduleJob(job)
+                    vms += [vm]
+                times = np.round(rng.uniform(0, 20, len(vms)))
+                VMDelayScheduler(infrastructure).scheduleVM(vms, times=times)
+            return sim, infrastructure._vmPlacementPolicy
+
+        model = Model_v0_np((3, 18), 6, 3)
+        model.setVars([np.random.RandomState(0).uniform(-1, 1, var.shape)
+                       for var in model.getVars()])
+        def Policy(batch):
+            return lambda ms: VMPlacementPolicyAI(ms, batch=batch,
+                                                  ModelClass=lambda *args: model)
+        env = VectorizedEnvironment([getSimulation(seed, Policy('external'))
+                                     for seed in range(4)])
+        env.run()
+        for seed, (sim, policy) in enumerate(env._simulations):
+            assert sim.time > 0 and not sim._running
+            expected, _ = getSimulation(seed, Policy('approximate'))
+            expected.simulate()
+            assert sim.time == expected.time
+
+        torch.manual_seed(0)
+        model = Model_v0_torch((3, 18), 6, 3)
+        Policy = lambda ms: PolicyGradient(ms, batch='external',
+                                           ModelClass=lambda *args: model)
+        env = VectorizedEnvironment([getSimulation(seed, Policy)
+                                     for seed in range(3)])
+        env.run()
+        assert sum([len(p._history) for p in env.policies]) == 3*40
+        before = [p.detach().clone() for p in model.parameters()]
+        env.policies[0].step(env.loss())
+        assert any(not torch.equal(p, q) for p, q in zip(before, model.parameters()))
+        assert all(len(p._history) == 0 for p in env.policies)
+
+    def test_parallelPolicyGradient(self):
+        import torch
+        from Generator import CreateVM, VMDelayScheduler
+        from scheduling.Models import Model_v0_torch
+        from scheduling.Trainers import PolicyGradient, ParallelPolicyGradient
+        def makeEpisode():
+            machines = []
+            for i in range(3):
+                resources = {Resource(RType.RAM, 16)}
+                for _ in range(2*i + 1):
+                    resources.add(Resource(RType.CPU_core, 2))
+                machines += [Machine(f"m{i}", resources,
+                                     lambda m: None, VMSchedulerSimple)]
+            infrastructure = Infrastructure(machines, lambda ms:
+                    PolicyGradient(ms, ModelClass=Model_v0_torch))
+            vms = []
+            for _ in range(30):
+                request = [ResourceRequest(RType.RAM, int(np.random.randint(1, 8))),
+                           ResourceRequest(RType.CPU_core, INF)]
+                job = Job(int(np.random.randint(1, 100)), request,
+                          priority=LinearPriority(np.random.rand(), 1))
+                vm = CreateVM.minimal([job])
+                vm.scheduleJob(job)
+                vms += [vm]
+            VMDelayScheduler(infrastructure, lambda n:
+                    np.round(np.random.uniform(0, 10, n))).scheduleVM(vms)
+            return infrastructure
+
+        torch.manual_seed(0)
+        models = [Model_v0_torch((3, 18), 6, 3) for _ in range(2)]
+        models[1].load_state_dict(models[0].state_dict())
+        losses = []
+        for model, n_workers in zip(models, (1, 2)):
+            trainer = ParallelPolicyGradient(makeEpisode, model, n_episodes=2,
+                                             n_workers=n_workers, seed=5)
+            losses += [trainer.train(2)]
+        assert losses[0] == losses[1]
+        for p, q in zip(*[model.parameters() for model in models]):
+            assert torch.allclose(p, q)
+        for (_, a), (_, b) in zip(*[model.named_buffers() for model in models]):
+            assert torch.allclose(a.float(), b.float())
+        assert Simulator.getInstance().time == 0
+
+    def test_rolloutDeterminism(self):
+        import torch
+        from Generator import CreateVM, VMDelayScheduler
+        from scheduling.Models import Model_v0_torch
+        from scheduling.Trainers import PolicyGradient, ParallelPolicyGradient
+        class Model(Model_v0_torch):
+            def __init__(self, *args):
+                super().__init__(*args)
+                self.unused = torch.nn.Parameter(torch.ones(2))
+        def makeEpisode():
+            machines = []
+            for i in range(6):
+                resources = {Resource(RType.RAM, 16)}
+                for _ in range(i + 1):
+                    resources.add(Resource(RType.CPU_core, 2))
+                machines += [Machine(f"m{i}", resources,
+                                     lambda m: None, VMSchedulerSimple)]
+            infrastructure = Infrastructure(machines, lambda ms:
+                    PolicyGradient(ms, ModelClass=Model))
+            vms = []
+            for _ in range(20):
+                request = [ResourceRequest(RType.RAM, int(np.random.randint(1, 8))),
+                           ResourceRequest(RType.CPU_core, INF)]
+                job = Job(int(np.random.randint(1, 100)), request,
+                          priority=LinearPriority(np.random.rand(), 1))
+                vm = CreateVM.minimal([job])
+                vm.scheduleJob(job)
+                vms += [vm]
+            VMDelayScheduler(infrastructure, lambda n:
+                    np.round(np.random.uniform(0, 10, n))).scheduleVM(vms)
+            return infrastructure
+
+        torch.manual_seed(0)
+        trainer = ParallelPolicyGradient(makeEpisode, Model((6, 18), 6, 6),
+                                         n_episodes=1, n_workers=1)
+        results = []
+        for shift in (0, 5, 11):
+            # as in a worker process which has run other episodes
+            for _ in range(shift):
+                Machine("other", set())
+            results += [trainer.rollouts()[0]]
+        for grads, loss, _ in results[1:]:
+            assert loss == results[0][1]
+            for g, h in zip(grads, results[0][0]):
+                assert torch.equal(g, h)
+        names = [name for name, _ in trainer.model.named_parameters()]
+        assert torch.equal(results[0][0][names.index('unused')], torch.zeros(2))
+        trainer.step()
+
+    def test_randomTrainerParallel(self):
+        from Generator import CreateVM, VMDelayScheduler
+        from scheduling.Models import Model_v0_np
+        from scheduling.VMPlacementPolicies import VMPlacementPolicyAI
+        from scheduling.Trainers import RandomTrainer
+        machines = []
+        for i in range(3):
+            resources = {Resource(RType.RAM, 16)}
+            for _ in range(2*i + 1):
+                resources.add(Resource(RType.CPU_core, 2))
+            machines += [Machine(f"m{i}", resources,
+                                 lambda m: None, VMSchedulerSimple)]
+        infrastructure = Infrastructure(machines, lambda ms:
+                VMPlacementPolicyAI(ms, ModelClass=Model_v0_np))
+        def score_fun(model):
+            infrastructure._vmPlacementPolicy._model = model
+            sim = Simulator.getInstance()
+            vms = []
+            for _ in range(20):
+                request = [ResourceRequest(RType.RAM, int(np.random.randint(1, 8))),
+                           ResourceRequest(RType.CPU_core, INF)]
+                job = Job(int(np.random.randint(1, 100)), request)
+                vm = CreateVM.minimal([job])
+                vm.scheduleJob(job)
+                vms += [vm]
+            VMDelayScheduler(infrastructure, lambda n:
+                    np.random.uniform(0, 10, n)).scheduleVM(vms)
+            sim.simulate()
+            return -sim.time
+
+        model = infrastructure._vmPlacementPolicy._model
+        runs = []
+        for _ in range(2):
+            np.random.seed(4)
+            trainer = RandomTrainer(model, score_fun, epoch_size=6,
+                                    n_bests=2, n_threads=2)
+            trainer.scoreThetas()
+            runs += [trainer._scores]
+        assert list(runs[0]) == list(runs[1])
+        assert len(set(runs[0])) > 1
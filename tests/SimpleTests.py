@@ -1,4 +1,6 @@
 import nose
+import sys
+import threading
 from tests.base_test import *
 from toolkit import INF
 from Simulator import *
@@ -143,3 +145,150 @@ class SimpleTests(SimulatorTests):
         sim.simulate()
         inspector.verify()
 
+
+
+    def test_heapQueueOrder(self):
+        queues = [Simulator.EventQueue(), Simulator.HeapEventQueue(compactionLimit=2)]
+        times = [3, 1, 2, 1, 0, 3, 2, 1, 1, 0]
+        priorities = [0, 10, 80, 100, 0, 20, 0, 10, 100, 80]
+        events = [Event(lambda: None, priority=p) for p in priorities]
+        for queue in queues:
+            for time, event in zip(times, events):
+                queue.addEvent(time, event)
+            for i in [1, 5, 6, 8]:
+                queue.removeEvent(events[i])
+        orders = [[queue.proceed() for _ in range(len(queue))]
+                  for queue in queues]
+        assert len(orders[0]) == 6
+        assert orders[0] == orders[1]
+
+
+    def test_3coresJobOn1coresMachine_heapQueue(self):
+        sim = Simulator.getInstance()
+        sim.setEventQueue(Simulator.HeapEventQueue)
+        self.test_3coresJobOn1coresMachine()
+
+
+    def test_eventHistory(self):
+        sim = Simulator.getInstance()
+        sim.setHistory(RingEventHistory(3))
+        self.test_3coresJobOn1coresMachine()
+        history = list(sim.history)
+        assert len(history) == 3
+        assert history[-1][0] == 12
+        assert history[-1][1].name == "JobFinish_Job_1"
+
+    def test_fileEventHistory(self):
+        import os, tempfile
+        fd, fname = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            sim = Simulator.getInstance()
+            history = FileEventHistory(fname)
+            sim.setHistory(history)
+            self.test_3coresJobOn1coresMachine()
+            noEvents = len(history)
+            assert noEvents > 0
+            assert len(list(history)) == noEvents
+            assert list(history)[-1] == (12, "JobFinish_Job_1")
+            history.clear()
+            assert len(history) == 0
+            assert list(history) == []
+            assert os.path.getsize(fname) == 0
+            # cleared simulator is reused with the same history
+            sim.clear()
+            with sim:
+                self.test_3coresJobOn1coresMachine()
+            assert len(history) == noEvents
+            assert list(history)[-1][0] == 12
+            sim.close()
+            assert history._file.closed
+        finally:
+            os.remove(fname)
+
+
+    def test_parallelSimulations(self):
+        def run(noJobs, results):
+            with Simulator() as sim:
+                resources = {
+                    Resource(RType.CPU_core, 10), # GHz
+                    Resource(RType.RAM, 16),      # GB
+                }
+                m0 = Machine("m0", resources)
+                for _ in range(noJobs):
+                    job = Job(100, [ResourceRequest(RType.CPU_core, INF),
+                                    ResourceRequest(RType.RAM, 1)])
+                    sim.addEvent(0, JobStart(job, m0))
+                sim.simulate()
+                results[noJobs] = sim.time
+
+        results = {}
+        threads = [threading.Thread(target=run, args=(n, results))
+                   for n in [1, 2, 4]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == {1: 10, 2: 20, 4: 40}
+        assert Simulator.getInstance().time == 0
+
+
+    def test_parallelIndices(self):
+        indices = []
+        def create():
+            events = [Event(lambda: None) for _ in range(2000)]
+            jobs = [Job(1, []) for _ in range(200)]
+            machines = [Machine("m", set()) for _ in range(200)]
+            indices.append(([e._index for e in events],
+                            [j._index for j in jobs],
+                            [m._index for m in machines]))
+
+        # switch threads as often as possible
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=create) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        for kind in range(3):
+            created = sum([created[kind] for created in indices], [])
+            assert len(set(created)) == len(created)
+
+
+    def test_subscribedListener(self):
+        class Counter(NotificationListener):
+            def __init__(self, **key):
+                self.received = []
+                self.subscribe(NType.JobFinish, **key)
+
+            def notify(self, notif):
+                self.received += [notif]
+
+        resources = {
+            Resource(RType.CPU_core, 10), # GHz
+            Resource(RType.RAM, 16),      # GB
+        }
+        m0 = Machine("m0", resources)
+        jobs = [Job(100, [ResourceRequest(RType.CPU_core, INF),
+                          ResourceRequest(RType.RAM, 1)]) for _ in range(3)]
+        sim = Simulator.getInstance()
+        for job in jobs:
+            sim.addEvent(0, JobStart(job, m0))
+        allFinishes = Counter()
+        oneFinish = Counter(job=jobs[1])
+        # matched by both subscriptions, notified once
+        bothFinishes = Counter(host=m0)
+        bothFinishes.subscribe(NType.JobFinish)
+        assert allFinishes not in sim._listeners
+        sim.simulate()
+        assert len(allFinishes.received) == 3
+        assert bothFinishes.received == allFinishes.received
+        assert all(n.what == NType.JobFinish for n in allFinishes.received)
+        assert [n.job for n in oneFinish.received] == [jobs[1]]
+        oneFinish.unregister()
+        sim.updateListeners()
+        assert oneFinish not in sim._subscriptions
@@ -1,11 +1,14 @@
 import nose
+import random
+from itertools import permutations
+from time import monotonic
 from tests.base_test import *
-from toolkit import INF
+from toolkit import INF, KineticHeap
 from Job import *
 from Machine import *
-from Generator import CreateVM
+from Generator import CreateVM, VMDelayScheduler
 from scheduling.Task import *
-from scheduling.Bins import TimelineBin
+from scheduling.Bins import *
 from scheduling.BinPackingScheduler import *
 
 
@@ -134,3 +137,330 @@ class ToolsTests(SimulatorTests):
 
         inspector.verify()
 
+
+    def test_binPackingClockReset(self):
+        rng = random.Random(2)
+        resources = {Resource(RType.RAM, 32)}
+        for _ in range(4):
+            resources.add(Resource(RType.CPU_core, 1))
+        m0 = Machine("m0", resources, lambda m: None, BinPackingScheduler)
+        infrastructure = Infrastructure([m0], VMPlacementPolicySimple)
+        sim = Simulator.getInstance()
+        for epoch in range(2):
+            # the same schedulers, simulation started again at time 0
+            sim._eventQueue._currentTime = 0
+            vms = []
+            for _ in range(20):
+                res = [ResourceRequest(RType.RAM, rng.randint(1, 8))]
+                for _ in range(rng.randint(1, 3)):
+                    res += [ResourceRequest(RType.CPU_core, INF)]
+                job = Job(rng.choice([10, 20, 40]), res,
+                          priority=LinearPriority(rng.random(), 1))
+                vm = CreateVM.minimal([job])
+                vm.scheduleJob(job)
+                vms += [vm]
+            times = [rng.choice([0, 5, 10, 30]) for _ in vms]
+            VMDelayScheduler(infrastructure).scheduleVM(vms, times=times)
+            sim.simulate()
+            assert sim.time > 30
+            assert m0._vmScheduler.noVMsLeft == 0
+        heap = KineticHeap(10)
+        heap.push('a', 1, 0)
+        heap.push('b', -1, 15)
+        assert heap.top() == 'a'
+        assert heap.top(0) == 'b'
+        assert heap.top(8) == 'a'
+
+    def test_vectorizedBinScoring(self):
+        rng = random.Random(0)
+        resources = {Resource(RType.RAM, 32)}
+        for _ in range(8):
+            resources.add(Resource(RType.CPU_core, 1))
+        for tolerance, limit in ((None, None), (0.5, None), (None, 3)):
+            m0 = Machine("m0", resources, lambda m: None,
+                         lambda m: BinPackingScheduler(
+                             m, binTasksLimit=limit,
+                             lengthDiffTolerance=tolerance))
+            scheduler = m0._vmScheduler
+            for _ in range(60):
+                res = [ResourceRequest(RType.RAM, rng.randint(1, 12))]
+                for _ in range(rng.randint(1, 4)):
+                    res += [ResourceRequest(RType.CPU_core, INF)]
+                job = Job(rng.choice([10, 20, 40, 80]), res)
+                vm = CreateVM.minimal([job])
+                vm.scheduleJob(job)
+                task = Task(vm, host_freqs=scheduler._host_freqs)
+                expected = None
+                bestScore = -INF
+                for bucket in scheduler._bins:
+                    score = scheduler.checkFitting(bucket, task)
+                    if score is not None and score[RType.CPU_core] > bestScore:
+                        expected = bucket
+                        bestScore = score[RType.CPU_core]
+                vec = scheduler._aggregates.taskVector(task)
+                assert scheduler.findBestFitting(vec, task.length) is expected
+                scheduler.schedule(vm)
+
+    def test_binAggregates(self):
+        rng = random.Random(1)
+        for BinClass in (SimpleBin, ReductiveBin):
+            bucket = BinClass({RType.CPU_core: 6, RType.RAM: 40})
+            tasks = []
+            for _ in range(30):
+                task = self.getTask(rng.choice([10, 30, 50]),
+                                    rng.randint(1, 4), rng.randint(1, 6))
+                if bucket.add(task):
+                    tasks += [task]
+                if len(tasks) > 0 and rng.random() < 0.3:
+                    bucket.remove(tasks.pop(rng.randrange(len(tasks))))
+                if len(tasks) == 0:
+                    continue
+                dims = Task.sum(tasks)
+                for rtype in bucket.maxDims.keys():
+                    assert bucket.currentDims[rtype] == dims.get(rtype, 0)
+                assert bucket.currentDims[RType.CPU_core] <= 6
+                assert bucket.length == max(t.length for t in tasks)
+                fresh = bucket.efficiency(tasks)
+                for rtype, eff in bucket.efficiency().items():
+                    assert abs(eff - fresh[rtype]) < 1e-9
+
+    def test_timelineOccupancyPlacement(self):
+        def referenceStart(tl, maxDims, task):
+            lastOK = None
+            for time in tl.timepoints():
+                occupied = Task.sum(tl[time])
+                allOK = True
+                for rtype, limit in maxDims.items():
+                    allOK *= occupied.get(rtype, 0) + task.dims.get(rtype, 0) \
+                          <= limit
+                if allOK:
+                    if lastOK is None:
+                        lastOK = time
+                    elif time - lastOK >= task.length:
+                        break
+                else:
+                    lastOK = None
+            return lastOK
+
+        rng = random.Random(2)
+        maxDims = {RType.CPU_core: 4, RType.RAM: 16}
+        tl = Timeline()
+        tasks = []
+        for _ in range(40):
+            task = self.getTask(rng.choice([7, 10, 13.3, 25, 40]),
+                                rng.randint(1, 4), rng.randint(1, 10))
+            expected = referenceStart(tl, maxDims, task) \
+                if len(tl.timepoints()) > 0 else 0
+            assert TimelineBin.addToTimeline(tl, maxDims, task)
+            assert task.startpoint == expected
+            tasks += [task]
+            if rng.random() < 0.3:
+                tl.remove(tasks.pop(rng.randrange(len(tasks))))
+            points, _ = tl.fittingMask({}, maxDims)
+            assert list(points) == list(tl.timepoints())
+            for idx, time in enumerate(tl.timepoints()):
+                occupied = Task.sum(tl[time])
+                for rtype in maxDims.keys():
+                    assert tl._occupancy[rtype][idx] == occupied.get(rtype, 0)
+
+    def test_orderedTimelineBinUndo(self):
+        rng = random.Random(3)
+        LongestFirstBin = OrderedTimelineBinClass(
+            orderLongestFirst, orderLongestFirst, orderLongestFirst)
+        for BinClass in (OrderedTimelineBin, LongestFirstBin):
+            bucket = BinClass({RType.CPU_core: 4, RType.RAM: 16})
+            for _ in range(15):
+                task = self.getTask(rng.choice([10, 20, 35]),
+                                    rng.randint(1, 3), rng.randint(1, 6))
+                before = bucket._tasks.copy()
+                assert bucket.add(task)
+                if rng.random() < 0.5:
+                    bucket.remove(task)
+                    tl = bucket._tasks
+                    assert dict(tl._dict.items()) == dict(before._dict.items())
+                    assert tl.allTasks == before.allTasks
+                    assert list(tl._points) == list(before._points)
+                    for rtype, occupied in before._occupancy.items():
+                        assert list(tl._occupancy[rtype]) == list(occupied)
+
+    def test_orderExhausive(self):
+        def bruteForce(tasks, maxDims):
+            best, bestScore = None, INF
+            for perm in permutations(tasks):
+                tl = Timeline()
+                for task in perm:
+                    TimelineBin.addToTimeline(tl, maxDims, task)
+                score = tl.timepoints()[-1] - tl.timepoints()[0]
+                if score < bestScore:
+                    best, bestScore = perm, score
+            return best, bestScore
+
+        rng = random.Random(4)
+        maxDims = {RType.CPU_core: 4, RType.RAM: 16}
+        for _ in range(10):
+            tl = Timeline()
+            tasks = []
+            for _ in range(rng.randint(2, 5)):
+                task = self.getTask(rng.choice([10, 20, 35, 50]),
+                                    rng.randint(1, 4), rng.randint(1, 9))
+                TimelineBin.addToTimeline(tl, maxDims, task)
+                tasks += [task]
+            order, score = bruteForce(list(tl.allTasks), maxDims)
+            layout = Timeline()
+            for task in order:
+                TimelineBin.addToTimeline(layout, maxDims, task)
+            expected = {task: task.startpoint for task in tasks}
+            result = orderExhausive(tl, maxDims)
+            assert result.timepoints()[-1] == score
+            assert {task: task.startpoint for task in tasks} == expected
+
+        tl = Timeline()
+        for _ in range(14):
+            task = self.getTask(rng.choice([10, 20, 35, 50]),
+                                rng.randint(1, 4), rng.randint(1, 9))
+            TimelineBin.addToTimeline(tl, maxDims, task)
+        limited = orderExhausive(tl, maxDims, nodeLimit=500)
+        longestFirst = orderLongestFirst(tl, maxDims)
+        assert len(limited.allTasks) == 14
+        assert limited.timepoints()[-1] <= longestFirst.timepoints()[-1]
+
+    def test_orderExhausiveBounds(self):
+        # usage-heavy tasks, for which the prefix area bound prunes
+        rng = random.Random(6)
+        maxDims = {RType.CPU_core: 4, RType.RAM: 16}
+        for _ in range(10):
+            tl = Timeline()
+            for _ in range(rng.randint(3, 6)):
+                task = self.getTask(rng.choice([5, 10, 15, 25]),
+                                    rng.randint(2, 4), rng.randint(5, 12))
+                TimelineBin.addToTimeline(tl, maxDims, task)
+            expected = INF
+            for perm in permutations(list(tl.allTasks)):
+                layout = Timeline()
+                for task in perm:
+                    TimelineBin.addToTimeline(layout, maxDims, task)
+                expected = min(expected, layout.timepoints()[-1])
+            result = orderExhausive(tl, maxDims)
+            assert abs(result.timepoints()[-1] - expected) < 1e-9
+
+        # search stops once the usage bound is reached
+        maxDims = {RType.CPU_core: 5, RType.RAM: 200}
+        tl = Timeline()
+        for i in range(15):
+            TimelineBin.addToTimeline(tl, maxDims, self.getTask(10, 1, i + 1))
+        start = monotonic()
+        result = orderExhausive(tl, maxDims, timeLimit=10)
+        assert monotonic() - start < 5
+        assert result.timepoints()[-1] == 30
+
+        # 15 tasks within budget of the examples
+        maxDims = {RType.CPU_core: 4, RType.RAM: 16}
+        tl = Timeline()
+        for _ in range(15):
+            task = self.getTask(rng.choice([10, 20, 35, 50]),
+                                rng.randint(1, 4), rng.randint(1, 9))
+            TimelineBin.addToTimeline(tl, maxDims, task)
+        start = monotonic()
+        limited = orderExhausive(tl, maxDims, nodeLimit=2000)
+        assert monotonic() - start < 30
+        assert len(limited.allTasks) == 15
+        longestFirst = orderLongestFirst(tl, maxDims)
+        assert limited.timepoints()[-1] <= longestFirst.timepoints()[-1]
+
+    def test_incrementalLongestFirst(self):
+        IncrementalBin = OrderedTimelineBinClass(
+            orderLongestFirst, orderLongestFirst, orderLongestFirst)
+        assert IncrementalBin.incrementalLongestFirst
+
+        rng = random.Random(6)
+        maxDims = {RType.CPU_core: 4, RType.RAM: 16}
+        bucket = IncrementalBin(maxDims)
+        pairs = [] # (task in bin, its twin) in order of arrival
+        for _ in range(40):
+            if len(pairs) > 0 and rng.random() < 0.3:
+                task, _ = pairs.pop(rng.randrange(len(pairs)))
+                bucket.remove(task)
+            else:
+                spec = (rng.choice([10, 20, 35]),
+                        rng.randint(1, 3), rng.randint(1, 6))
+                pairs += [(self.getTask(*spec), self.getTask(*spec))]
+                assert bucket.add(pairs[-1][0])
+                if rng.random() < 0.5:
+                    bucket.remove(pairs.pop()[0])
+            rebuilt = Timeline()
+            for twin in sorted([twin for _, twin in pairs],
+                               key=lambda t: -t.length):
+                TimelineBin.addToTimeline(rebuilt, maxDims, twin)
+            for task, twin in pairs:
+                assert task.startpoint == twin.startpoint
+            assert list(bucket._tasks.timepoints()) == list(rebuilt.timepoints())
+
+    def test_taskLengthCache(self):
+        task = self.getTask(120, 4, 1)
+        assert task.length == 30
+        assert task.reduceCores() == 4
+        assert task.dims[RType.CPU_core] == 3
+        assert task.length == 40
+        assert task.restoreCores(1) == 4
+        assert task.length == 30
+        assert task.restoreCores() == 4
+        assert task.length == 30
+
+    def test_kineticHeap(self):
+        rng = random.Random(7)
+        slopes = [-1, 0, 0.5, 1, 2]
+        intercepts = [0, 1, 2, 3.5, 10]
+        for _ in range(20):
+            heap = KineticHeap()
+            keys = {} # {item: (slope, intercept, insertion)}
+            time = 0
+            for n in range(200):
+                r = rng.random()
+                if r < 0.4 or len(keys) == 0:
+                    keys[n] = (rng.choice(slopes), rng.choice(intercepts), n)
+                    heap.push(n, *keys[n][:2])
+                elif r < 0.6:
+                    item = rng.choice(list(keys))
+                    del keys[item]
+                    heap.remove(item)
+                elif r < 0.8:
+                    item = rng.choice(list(keys))
+                    keys[item] = (rng.choice(slopes), rng.choice(intercepts),
+                                  keys[item][2])
+                    heap.update(item, *keys[item][:2])
+                else:
+                    time += rng.choice([0, 0.25, 0.5, 1, 3])
+                    heap.advance(time)
+                if len(keys) > 0:
+                    best = max(keys, key=lambda i: (keys[i][0]*time + keys[i][1],
+                                                    -keys[i][2]))
+                    assert heap.top() == best
+
+
+    def test_priorityObjects(self):
+        from Listeners import AUPMetric, PriorityIncreaseMetric
+        linear = LinearPriority(2, 1)
+        piecewise = PiecewiseLinearPriority([(0, 1), (2, 5), (4, 5)])
+        fs = [ConstantPriority(3), linear, linear.shifted(1.5),
+              Priority.shift(lambda t: 2*t + 1, 1.5), piecewise,
+              Priority.shift(piecewise, 1)]
+        scheds = [0, 0.5, 2, 2, 1, 0]
+        starts = [1, 3, 4, 4.5, 3, 4]
+        values = Priority.evaluate(fs, starts)
+        for f, start, value in zip(fs, starts, values):
+            assert value == f(start)
+        assert list(Priority.evaluate(fs, 2)) == [f(2) for f in fs]
+        assert fs[2].coefficients == (2, -2)
+        assert fs[3].coefficients is None
+        assert Job(1, [], priority=3).linearPriority == (0, 3)
+        # exact area, also over the breakpoints of piecewise priority
+        expected = [3, 11.25, 8, 11.25, 9, 12]
+        areas = Priority.integrate(fs, scheds, starts)
+        assert np.allclose(areas, expected)
+        assert np.allclose(AUPMetric._calculateCosts(scheds, starts, fs),
+                           [AUPMetric._calculateCost(*a)
+                            for a in zip(scheds, starts, fs)])
+        assert np.allclose(
+            PriorityIncreaseMetric._calculateCosts(scheds, starts, fs),
+            [PriorityIncreaseMetric._calculateCost(*a)
+             for a in zip(scheds, starts, fs)])
@@ -1,3 +1,4 @@
+import itertools
 import nose
 from unittest import TestCase
 from Simulator import *
@@ -9,9 +10,9 @@ from Job import *
 class SimulatorTests(TestCase):
 
     def setUp(self):
-        Event._noCreated = 0
-        Job._noCreated = 0
-        Machine._noCreated = 0
+        Event._indices = itertools.count()
+        Job._indices = itertools.count()
+        Machine._indices = itertools.count()
         sim = Simulator.getInstance()
         assert sim.time == 0
         assert len(sim._eventQueue._todo) == 0